@@ -1,46 +1,352 @@
+# Taken before any other import so the startup report covers import time too.
+from time import perf_counter
+STARTED = perf_counter()
+
+from argparse import ArgumentParser
+from ctypes import c_float, sizeof as size_in_memory
+from typing import Optional
+from warnings import warn
+
 import pyglet
 
 from boid import Flock
 from timer import Timer
 from vectors import Vec2
 
+IMPORTED = perf_counter()
+
+ENGINES = "objects", "pairs", "array", "parallel", "jit", "gpu"
+
+
+def create_flock(
+        count: int, bound_radius: float, backend: str = "quadtree", engine: str = "objects",
+        timer: Optional[Timer] = None, seed: Optional[int] = None
+):
+    """Every engine given the same seed starts from the same boids."""
+    if engine == "objects":
+        return Flock(count, Vec2(0., 0.), bound_radius, backend, timer, seed=seed)
+    elif engine == "pairs":
+        return Flock(count, Vec2(0., 0.), bound_radius, backend, timer, pairwise=True, seed=seed)
+    elif engine == "array":
+        # numpy is only needed for the array engine.
+        from arrayflock import ArrayFlock
+        return ArrayFlock(count, Vec2(0., 0.), bound_radius, timer=timer, seed=seed)
+    elif engine == "parallel":
+        from parallelflock import ParallelFlock
+        return ParallelFlock(count, Vec2(0., 0.), bound_radius, timer=timer, seed=seed)
+    elif engine == "jit":
+        from jitflock import JIT_AVAILABLE, JitFlock
+        if not JIT_AVAILABLE:
+            warn("numba is not installed, falling back to the pure-Python flock")
+            return Flock(count, Vec2(0., 0.), bound_radius, backend, timer, seed=seed)
+
+        return JitFlock(count, Vec2(0., 0.), bound_radius, timer=timer, seed=seed)
+    elif engine == "gpu":
+        # Needs a current OpenGL context.
+        from gpuflock import GPUFlock
+        return GPUFlock(count, Vec2(0., 0.), bound_radius, timer, seed)
+    else:
+        raise ValueError(f"Unknown flock engine {engine!r}")
+
 
 class Simulation:
-    FPS = 30.
+    # Rate the window is redrawn at.
+    FPS = 60.
+
+    # Rate the flock is stepped at, independent of the frame rate.
+    TICK_RATE = 30.
+
+    # Most ticks run in one frame before the simulation gives up on catching up.
+    MAX_TICKS_PER_FRAME = 4
+
+    # Zoom factor per scroll wheel step, and its limits.
+    ZOOM_STEP = 1.1
+    MIN_ZOOM = 0.01
+    MAX_ZOOM = 10.
+
+    # How far the arrow keys seek a replay, in seconds of recording.
+    SEEK_SECONDS = 5.
+
+    def __init__(
+            self, width: int, height: int, backend: str = "quadtree", engine: str = "objects",
+            exit_after_first_frame: bool = False, seed: Optional[int] = None, record: Optional[str] = None,
+            replay: Optional[str] = None, scene: bool = False
+    ):
+        """
+        With `replay`, play back a recorded trajectory instead of simulating a flock.
+        With `scene`, simulate the demo Scene of several species instead of one flock.
+        """
+        # Imported here so headless runs never touch OpenGL.
+        from drawables import BoidRenderer
 
-    def __init__(self, width: int, height: int):
         self.width = width
         self.height = height
+        self.zoom = 1.
 
         self.timer = Timer()
+        self.accumulator = 0.
+        self.dropped_ticks = 0
+        self.startup = [("imports", IMPORTED)]
+        self.exit_after_first_frame = exit_after_first_frame
 
         self.window = pyglet.window.Window(width, height, "Flox")
         self.fps = pyglet.window.FPSDisplay(self.window)
+        self.startup.append(("window", perf_counter()))
+
+        self.replay = None
+        self.scene = None
+        if replay is not None:
+            from replay import Replay
+            self.flock = self.replay = Replay(replay)
+        elif scene:
+            from scene import Scene, demo
+            self.flock = self.scene = Scene(demo(150), min(width, height) / 3, backend, self.timer, seed)
+        else:
+            self.flock = create_flock(150, min(width, height) / 3, backend, engine, self.timer, seed)
 
-        self.flock = Flock(150, Vec2(0., 0.), min(width, height) / 3)
-        self.flock.renderer.set_world(width, height)
+        self.recorder = None
+        if record is not None:
+            from recorder import TrajectoryWriter
+            self.flock.recorder = self.recorder = TrajectoryWriter(record)
+
+        self.startup.append(("flock", perf_counter()))
+
+        self.renderer = BoidRenderer(self.flock.count)
+        self.renderer.set_world(width, height)
+
+        # Revision of the scene the renderer last got the species of.
+        self.species_revision = 0
+        if self.scene is not None:
+            self.renderer.set_colors(self.scene.colors)
+            self.upload_species()
+
+        self.startup.append(("renderer", perf_counter()))
 
     def update(self, dt: float):
-        # self.timer.timed(self.flock.update)(dt)
-        self.flock.update(dt)
+        tick = 1. / self.TICK_RATE
+        self.accumulator += dt
+
+        ticks = 0
+        while self.accumulator >= tick and ticks < self.MAX_TICKS_PER_FRAME:
+            self.step(tick)
+            self.accumulator -= tick
+            ticks += 1
+
+        if self.accumulator >= tick:
+            # Too far behind to catch up. Drop the backlog instead of
+            # spending ever longer frames chasing it.
+            dropped = int(self.accumulator // tick)
+            self.dropped_ticks += dropped
+            self.accumulator -= dropped * tick
+
+    def step(self, tick: float):
+        self.flock.update(tick)
+        self.step_upload()
+
+    def step_upload(self):
+        self.upload_species()
+        with self.timer.section("upload"):
+            # boid_data may have room for more boids than the flock has.
+            size = self.flock.count * 3 * size_in_memory(c_float)
+            render_buffer = getattr(self.flock, "render_buffer", None)
+            if render_buffer is not None:
+                # Already on the GPU.
+                self.renderer.copy_from(render_buffer, size)
+            else:
+                self.renderer.update(self.flock.boid_data, size)
+
+    def upload_species(self):
+        """Give the renderer the scene's species again, if its boids changed."""
+        scene = self.scene
+        if scene is None or scene.revision == self.species_revision:
+            return
+
+        # Boids may have moved between flocks' places in boid_data, so don't interpolate across the change.
+        self.renderer.reset()
+        self.renderer.set_species(scene.species_data, scene.count)
+        self.species_revision = scene.revision
 
     def on_draw(self):
         self.window.clear()
 
         self.fps.draw()
-        # self.timer.timed(self.flock.draw)()
-        self.flock.draw()
+        # Draw part way between the last two ticks, by how far we are into the next one.
+        alpha = self.accumulator * self.TICK_RATE
+
+        with self.timer.section("draw"):
+            self.renderer.draw(alpha)
+
+        if self.startup is not None:
+            self.startup.append(("first frame", perf_counter()))
+            self.show_startup()
+            self.startup = None
+
+            if self.exit_after_first_frame:
+                pyglet.app.exit()
+
+    def on_key_press(self, symbol: int, modifiers: int):
+        """
+        Replay controls: space pauses, the left and right arrows seek, up and
+        down double and halve the speed, and home goes back to the start.
+        """
+        replay = self.replay
+        if replay is None:
+            return
+
+        key = pyglet.window.key
+        if symbol == key.SPACE:
+            replay.paused = not replay.paused
+        elif symbol in (key.LEFT, key.RIGHT, key.HOME):
+            if symbol == key.HOME:
+                replay.seek(0)
+            else:
+                step = self.SEEK_SECONDS * self.TICK_RATE
+                replay.seek(replay.position + (step if symbol == key.RIGHT else -step))
+
+            # Jumped, so there is nothing to interpolate from.
+            self.renderer.reset()
+            self.step_upload()
+        elif symbol == key.UP:
+            replay.speed *= 2.
+        elif symbol == key.DOWN:
+            replay.speed /= 2.
+
+    def on_mouse_press(self, x: int, y: int, button: int, modifiers: int):
+        """Left click adds a boid under the cursor, right click removes the newest one."""
+        if button == pyglet.window.mouse.LEFT:
+            # The projection puts the origin in the middle of the window.
+            self.flock.add((x - self.width / 2) / self.zoom, (y - self.height / 2) / self.zoom)
+        elif button == pyglet.window.mouse.RIGHT and self.flock.count:
+            index = self.flock.count - 1
+            self.flock.remove(index)
+            self.renderer.remove(index)
+
+        # The new boid is drawn before the next tick uploads, and needs its species by then.
+        self.upload_species()
+
+    def on_mouse_scroll(self, x: int, y: int, scroll_x: float, scroll_y: float):
+        """Zoom in and out. Far enough out, the boids are drawn as points."""
+        self.zoom = min(max(self.zoom * self.ZOOM_STEP ** scroll_y, self.MIN_ZOOM), self.MAX_ZOOM)
+        self.renderer.set_world(self.width, self.height, self.zoom)
+
+    def show_startup(self):
+        print(f"Startup: {(self.startup[-1][1] - STARTED) * 1000.:.1f}ms")
+        previous = STARTED
+        for phase, finished in self.startup:
+            print(f"    {phase}: {(finished - previous) * 1000.:.1f}ms")
+            previous = finished
 
     def on_close(self):
-        self.timer.show_graph()
+        if self.recorder is not None:
+            self.recorder.close()
+            print(f"Recorder stalls: {self.recorder.stalls}")
+
+        if self.replay is not None:
+            self.replay.close()
+
+        self.timer.show()
+        print(f"Upload stalls: {self.renderer.stalls}")
 
     def run(self):
         self.window.push_handlers(self.on_draw)
         self.window.push_handlers(self.on_close)
+        if self.replay is None:
+            # A replay only plays back what was recorded.
+            self.window.push_handlers(self.on_mouse_press)
+        self.window.push_handlers(self.on_mouse_scroll)
+        self.window.push_handlers(self.on_key_press)
         pyglet.clock.schedule_interval(self.update, 1. / self.FPS)
         pyglet.app.run()
 
 
+class HeadlessSimulation:
+    """Steps a flock as fast as possible, without a window or, except for the gpu engine, an OpenGL context."""
+
+    def __init__(
+            self, count: int, bound_radius: float, backend: str = "quadtree", engine: str = "objects",
+            timer: Optional[Timer] = None, seed: Optional[int] = None, snapshot: Optional[str] = None,
+            scene: bool = False
+    ):
+        """
+        Steps a new flock, or with `snapshot`, the object flock saved there, or with
+        `scene`, the demo Scene with `count` boids across its species.
+        """
+        self.context = None
+        if engine == "gpu":
+            from gpuflock import create_context
+            self.context = create_context()
+
+        if snapshot is not None:
+            from snapshot import load
+            self.flock = load(snapshot, timer)
+        elif scene:
+            from scene import Scene, demo
+            self.flock = Scene(demo(count), bound_radius, backend, timer, seed)
+        else:
+            self.flock = create_flock(count, bound_radius, backend, engine, timer, seed)
+
+    def run(self, ticks: int, dt: float = 1. / Simulation.TICK_RATE) -> float:
+        """Advance `ticks` fixed steps of `dt` and return the wall-clock seconds taken."""
+        update = self.flock.update
+
+        start = perf_counter()
+        for _ in range(ticks):
+            update(dt)
+
+        if self.context is not None:
+            # Wait for the queued GPU work, or only the submission would be timed.
+            from pyglet.gl import glFinish
+            glFinish()
+
+        return perf_counter() - start
+
+
 if __name__ == '__main__':
-    sim = Simulation(1440, 1080)
-    sim.run()
+    parser = ArgumentParser(description="Flocking simulation")
+    parser.add_argument("--headless", type=int, metavar="TICKS", help="step the flock TICKS times without a window")
+    parser.add_argument("--count", type=int, default=150, help="number of boids in a headless run")
+    parser.add_argument("--backend", default="quadtree", choices=Flock.BACKENDS)
+    parser.add_argument("--engine", default="objects", choices=ENGINES)
+    parser.add_argument("--profile", action="store_true", help="print per-phase timings of a headless run")
+    parser.add_argument("--startup", action="store_true", help="report the time to the first frame, then exit")
+    parser.add_argument("--seed", type=int, help="seed for the flock's random draws")
+    parser.add_argument("--load", metavar="SNAPSHOT", help="resume a headless run from a snapshot")
+    parser.add_argument("--save", metavar="SNAPSHOT", help="snapshot the flock at the end of a headless run")
+    parser.add_argument("--record", metavar="TRAJECTORY", help="stream every tick's boids to a trajectory file")
+    parser.add_argument("--replay", metavar="TRAJECTORY", help="play back a recorded trajectory instead of simulating")
+    parser.add_argument("--scene", action="store_true", help="simulate several species of flock, with the objects engine")
+    args = parser.parse_args()
+
+    if args.scene and args.engine != "objects":
+        parser.error("--scene only runs with the objects engine")
+
+    if args.headless is not None:
+        timer = Timer() if args.profile else None
+        headless = HeadlessSimulation(
+            args.count, 1080 / 3, args.backend, args.engine, timer, args.seed, args.load, args.scene
+        )
+
+        if args.record is not None:
+            from recorder import TrajectoryWriter
+            headless.flock.recorder = TrajectoryWriter(args.record)
+
+        elapsed = headless.run(args.headless)
+        if args.record is not None:
+            # Waits for the writer thread to catch up, after the timed run.
+            headless.flock.recorder.close()
+            print(f"Recorder stalls: {headless.flock.recorder.stalls}")
+
+        count = headless.flock.count
+        print(f"{args.headless} ticks of {count} boids in {elapsed:.3f}s ({args.headless / elapsed:.1f} ticks/s)")
+
+        if args.save is not None:
+            from snapshot import save
+            save(headless.flock, args.save)
+
+        if timer is not None:
+            timer.show()
+    else:
+        sim = Simulation(
+            1440, 1080, args.backend, args.engine, args.startup, args.seed, args.record, args.replay, args.scene
+        )
+        sim.run()
@@ -0,0 +1,349 @@
+from ctypes import c_float, memmove, sizeof
+from time import perf_counter
+from typing import Optional, Tuple
+
+import numpy as np
+
+from arrayvectors import Vec2Array
+from boid import Boid, seeded, spawn
+from recorder import Recorded
+from timer import Timer
+from vectors import Vec2
+
+
+class Grid:
+    """
+    Boids binned into square cells by sorting them on their cells' keys, so
+    each boid only looks for neighbors among the boids of the block of cells
+    `span` cells either side of its own. The cells must be at least the
+    alignment range over `span` across. Smaller cells and a wider span fit the
+    block closer to the alignment circle, so fewer candidates fall outside it.
+
+    The arrays are filled in place while they have room, so they can be views
+    of shared memory that other processes read the grid from.
+    """
+
+    __slots__ = "inverse", "span", "order", "keys", "frame"
+
+    inverse: float
+    span: int
+
+    # The boids in cell order, and the key of each one's cell in that order.
+    order: np.ndarray
+    keys: np.ndarray
+
+    # Boids binned, the column and row of the grid's first cell and its width in cells.
+    # The grid has `span` spare cells on every side, so a neighboring cell's key never wraps onto another row.
+    frame: np.ndarray
+
+    def __init__(
+            self, cell_size: float, span: int = 1, order: Optional[np.ndarray] = None,
+            keys: Optional[np.ndarray] = None, frame: Optional[np.ndarray] = None
+    ):
+        self.inverse = 1. / cell_size
+        self.span = span
+        self.order = np.empty(0, dtype=np.int64) if order is None else order
+        self.keys = np.empty(0, dtype=np.int64) if keys is None else keys
+        self.frame = np.zeros(4, dtype=np.int64) if frame is None else frame
+
+    def cells(self, points: np.ndarray) -> np.ndarray:
+        """Key of the cell each of `points` falls in."""
+        _, column, row, width = self.frame
+        cells = np.floor(points * self.inverse).astype(np.int64)
+        return (cells[:, 1] - row) * width + (cells[:, 0] - column)
+
+    def rebuild(self, points: np.ndarray):
+        count = len(points)
+        if len(self.order) < count:
+            self.order = np.empty(2 * count, dtype=np.int64)
+            self.keys = np.empty(2 * count, dtype=np.int64)
+
+        cells = np.floor(points * self.inverse).astype(np.int64)
+        if count:
+            column, row = cells.min(axis=0) - self.span
+            width = cells[:, 0].max() - column + 1 + self.span
+        else:
+            column = row = 0
+            width = 1
+
+        self.frame[:] = count, column, row, width
+        keys = (cells[:, 1] - row) * width + (cells[:, 0] - column)
+        order = np.argsort(keys, kind="stable")
+        self.order[:count] = order
+        self.keys[:count] = keys[order]
+
+    def _runs(self, points: np.ndarray, boids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Where each cell of the block around each of `boids` starts in the sorted
+        keys, and how many boids it holds, as (cells in the block, boids) arrays.
+        """
+        count, _, _, width = self.frame
+        keys = self.keys[:count]
+
+        steps = np.arange(-self.span, self.span + 1)
+        offsets = (steps[:, None] * width + steps[None, :]).ravel()
+        neighbors = self.cells(points[boids])[None, :] + offsets[:, None]
+
+        # Each neighboring cell's boids are one run of the sorted keys.
+        low = np.searchsorted(keys, neighbors, "left")
+        return low, np.searchsorted(keys, neighbors, "right") - low
+
+    def counts(self, points: np.ndarray, boids: np.ndarray) -> np.ndarray:
+        """How many candidates each of `boids` has."""
+        return self._runs(points, boids)[1].sum(axis=0)
+
+    def candidates(self, points: np.ndarray, boids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Every boid in the block of cells around each of `boids`, including
+        itself, as (index into boids, other boid) pairs.
+        """
+        low, sizes = self._runs(points, boids)
+        rows = np.repeat(np.broadcast_to(np.arange(len(boids)), low.shape).ravel(), sizes.ravel())
+
+        low = low.ravel()
+        sizes = sizes.ravel()
+        first = np.repeat(low - np.cumsum(sizes) + sizes, sizes)
+        others = self.order[first + np.arange(len(first))]
+
+        return rows, others
+
+
+def row_sums(rows: np.ndarray, values: np.ndarray, count: int) -> np.ndarray:
+    """Sum the (n, 2) `values` into `count` rows, by the row each belongs to."""
+    return np.stack((
+        np.bincount(rows, values[:, 0], count),
+        np.bincount(rows, values[:, 1], count),
+    ), axis=1)
+
+
+def flocking(
+        previous: np.ndarray, positions: np.ndarray, velocities: np.ndarray, boids: np.ndarray, grid: Grid
+) -> np.ndarray:
+    """Weighted alignment, cohesion and separation for `boids`, from their candidates in `grid`."""
+    count = len(boids)
+    dtype = positions.dtype
+    own_positions = positions[boids]
+    own_velocities = velocities[boids]
+
+    # Squared distances to every candidate, from the start of the tick.
+    # np.take gathers whole rows several times faster than fancy indexing.
+    rows, others = grid.candidates(previous, boids)
+    own = boids[rows]
+    delta = np.take(previous, others, axis=0)
+    delta -= np.take(previous, own, axis=0)
+    distances = np.einsum("ij,ij->i", delta, delta)
+
+    ar = Boid.ALIGN_RANGE
+    sr = Boid.SEPARATE_RANGE
+    near = (distances < ar * ar) & (others != own)
+    rows = rows[near]
+    others = others[near]
+    distances = distances[near]
+
+    align_total = np.bincount(rows, minlength=count)
+    aligning = align_total > 0
+
+    result = np.zeros((count, 2), dtype=dtype)
+
+    # **** Alignment and Cohesion ****
+    if aligning.any():
+        velocity_sum = row_sums(rows, np.take(velocities, others, axis=0), count)[aligning]
+        position_sum = row_sums(rows, np.take(positions, others, axis=0), count)[aligning]
+        totals = align_total[aligning, None]
+
+        alignment = Vec2Array((velocity_sum / totals).astype(dtype, copy=False))
+        alignment.steer(own_velocities[aligning], Boid.MAX_SPEED, Boid.MAX_FORCE)
+
+        cohesion = Vec2Array((position_sum / totals).astype(dtype, copy=False) - own_positions[aligning])
+        cohesion.steer(own_velocities[aligning], Boid.MAX_SPEED, Boid.MAX_FORCE)
+
+        result[aligning] += alignment.divs(4.).data
+        result[aligning] += cohesion.divs(16.).data
+
+    # **** Separation ****
+    separate = distances < sr * sr
+    if separate.any():
+        rows = rows[separate]
+        others = others[separate]
+
+        # Inverse square weighting from the current positions, like Boid.separation.
+        away = np.take(own_positions, rows, axis=0)
+        away -= np.take(positions, others, axis=0)
+        away_2 = np.einsum("ij,ij->i", away, away)
+        np.divide(away, away_2[:, None], out=away, where=away_2[:, None] > 0.)
+
+        separate_total = np.bincount(rows, minlength=count)
+        separating = separate_total > 0
+        away = row_sums(rows, away, count)[separating].astype(dtype, copy=False)
+
+        separation = Vec2Array(away).divs(separate_total[separating])
+        separation.steer(own_velocities[separating], Boid.MAX_SPEED, Boid.MAX_FORCE)
+
+        result[separating] += separation.divs(2.).data
+
+    return result
+
+
+def flock_range(
+        previous: np.ndarray, positions: np.ndarray, velocities: np.ndarray, accelerations: np.ndarray,
+        boids: np.ndarray, grid: Grid, block: int = 1 << 21
+):
+    """
+    Add the flocking forces for `boids` to their accelerations, a block of boids
+    with about `block` candidates between them at a time, so memory stays
+    bounded however crowded the flock gets.
+    """
+    totals = np.cumsum(grid.counts(previous, boids))
+    first = 0
+    while first < len(boids):
+        done = totals[first - 1] if first else 0
+        last = max(first + 1, int(np.searchsorted(totals, done + block, "right")))
+
+        part = boids[first:last]
+        accelerations[part] += flocking(previous, positions, velocities, part, grid)
+        first = last
+
+
+class ArrayFlock(Recorded):
+    """
+    Structure-of-arrays flock.
+
+    Follows the same rules as Flock, but keeps every boid in a handful of (count, 2)
+    arrays. Every tick the boids are sorted into a Grid, and the steering forces
+    are computed from each boid's candidates there, for blocks of boids at a time.
+    """
+
+    # Candidate neighbors held in memory at once.
+    BLOCK_PAIRS = 1 << 21
+
+    def __init__(
+            self, count: int, start: Vec2, bound_radius: float, dtype=np.float64,
+            timer: Optional[Timer] = None, seed: Optional[int] = None
+    ):
+        self.bound = bound_radius
+        self.timer = timer
+        self.count = count
+        self.dtype = dtype
+
+        # The same boids as a Flock with the same seed.
+        self.seed, self.random = seeded(seed)
+        spawned = list(spawn(count, start, self.random))
+        positions = [(x, y) for x, y, _ in spawned]
+        velocities = [(velocity.x, velocity.y) for _, _, velocity in spawned]
+
+        # Every per-boid array is a view of the first `count` rows of a larger one,
+        # so boids can be added without reallocating each time.
+        self.storage = {
+            "positions": np.array(positions, dtype=dtype).reshape(count, 2),
+            "velocities": np.array(velocities, dtype=dtype).reshape(count, 2),
+            "accelerations": np.zeros((count, 2), dtype=dtype),
+            "previous": np.zeros((count, 2), dtype=dtype),
+        }
+
+        # Half range cells, so a boid's 5x5 block of them covers less area than a 3x3 block of range sized ones.
+        self.grid = Grid(Boid.ALIGN_RANGE / 2, 2)
+
+        # Interleaved x, y, heading per boid, in the layout BoidRenderer uploads.
+        # `state` is a (count, 3) view over the same memory, so filling it fills the upload buffer.
+        self.boid_data = (c_float * (3 * count))()
+        self.view()
+
+    def view(self):
+        """Point the per-boid arrays at the first `count` rows of the storage."""
+        count = self.count
+        for name, array in self.storage.items():
+            setattr(self, name, array[:count])
+
+        self.state = np.frombuffer(self.boid_data, dtype=np.float32).reshape(-1, 3)[:count]
+
+    def reserve(self, count: int):
+        """Make room for `count` boids, at least doubling the storage so growing is amortized O(1)."""
+        capacity = len(self.boid_data) // 3
+        if count <= capacity:
+            return
+
+        capacity = max(count, 2 * capacity)
+        for name, array in self.storage.items():
+            grown = np.zeros((capacity, 2), dtype=self.dtype)
+            grown[:len(array)] = array
+            self.storage[name] = grown
+
+        boid_data = (c_float * (3 * capacity))()
+        memmove(boid_data, self.boid_data, sizeof(self.boid_data))
+        self.boid_data = boid_data
+        self.view()
+
+    def add(self, x: float, y: float) -> int:
+        """Add a boid at (x, y), flying in a random direction, and return its index."""
+        index = self.count
+        self.reserve(index + 1)
+        self.count += 1
+        self.view()
+
+        velocity = Vec2.from_random(Boid.MAX_SPEED, self.random)
+        self.positions[index] = x, y
+        self.velocities[index] = velocity.x, velocity.y
+        self.accelerations[index] = 0.
+        self.previous[index] = x, y
+        self.state[index] = x, y, velocity.angle
+
+        return index
+
+    def remove(self, index: int):
+        """Remove the boid at `index`, moving the last boid into its place."""
+        last = self.count - 1
+        for array in (self.positions, self.velocities, self.accelerations, self.previous, self.state):
+            array[index] = array[last]
+
+        self.count = last
+        self.view()
+
+    def update(self, dt: float):
+        start = perf_counter()
+        self.integrate(dt)
+        integrated = perf_counter()
+
+        grid = self.grid
+        grid.rebuild(self.previous)
+        # In cell order, so each block reads boids close together in memory.
+        flock_range(
+            self.previous, self.positions, self.velocities, self.accelerations,
+            grid.order[:self.count], grid, self.BLOCK_PAIRS
+        )
+        steered = perf_counter()
+
+        self.write_state()
+        # Binning the boids and finding their neighbors are part of steering here.
+        self.record(integration=integrated - start, steering=steered - integrated, state=perf_counter() - steered)
+
+    def integrate(self, dt: float):
+        """Move every boid, then restart its acceleration from the bound and speed terms."""
+        positions = self.positions
+        velocities = self.velocities
+        accelerations = self.accelerations
+
+        # Where each boid starts the tick, which is where the grid bins it.
+        self.previous[:] = positions
+
+        # ****** Update Boids ******
+        velocities += accelerations
+        positions += velocities * dt
+
+        # stay near the origin
+        bound = self.bound
+        outside = np.einsum("ij,ij->i", positions, positions) > bound * bound
+        accelerations[:] = 0.
+        if outside.any():
+            origin_seek = -Vec2Array(positions[outside])
+            origin_seek.steer(velocities[outside], Boid.MAX_SPEED, Boid.MAX_FORCE)
+            accelerations[outside] = origin_seek.divs(1.5).data
+
+        speed_up = Vec2Array(velocities).copy()
+        speed_up.steer(velocities, Boid.MAX_SPEED, Boid.MAX_FORCE / 2)
+        accelerations += speed_up.data
+
+    def write_state(self):
+        # ****** Update Drawable Shape ******
+        state = self.state
+        state[:, :2] = self.positions
+        np.arctan2(self.velocities[:, 1], self.velocities[:, 0], out=state[:, 2])
@@ -0,0 +1,208 @@
+"""Vec2Array, kept apart from vectors so the pure-Python engines never import numpy."""
+from math import tau
+
+import numpy as np
+
+from vectors import Vec2
+
+
+def _scalars(val):
+    """Scalars pass through, one value per vector becomes a column that broadcasts over x and y."""
+    # NumPy scalars, such as np.float32(2), count as scalars too.
+    if np.ndim(val) == 0:
+        return val
+
+    return np.asarray(val)[:, None]
+
+
+def _vectors(other):
+    """Another Vec2Array, or one Vec2 that broadcasts over every vector."""
+    if isinstance(other, Vec2Array):
+        return other.data
+    elif isinstance(other, Vec2):
+        return np.array((other.x, other.y))
+
+    return other
+
+
+class Vec2Array:
+    """
+    N 2D vectors in one contiguous (N, 2) array, with the same vocabulary as Vec2.
+
+    Every method applies element-wise to the whole array in one vectorized call.
+    Scalar arguments may also be given as one value per vector. In place methods
+    return self so they can be chained, like Vec2's.
+    """
+
+    __slots__ = "data",
+
+    data: "np.ndarray"
+
+    def __init__(self, data):
+        """Wrap an existing (N, 2) array without copying it, or create N zero vectors from an int."""
+        if isinstance(data, int):
+            data = np.zeros((data, 2))
+        elif not isinstance(data, np.ndarray):
+            data = np.asarray(data, dtype=float).reshape(-1, 2)
+
+        self.data = data
+
+    @classmethod
+    def from_random(cls, count: int, strength: float, rng=None):
+        rng = np.random.default_rng() if rng is None else rng
+        return cls.from_polar(strength, tau * rng.random(count))
+
+    @classmethod
+    def from_polar(cls, magnitude, angle):
+        angle = np.asarray(angle, dtype=float)
+        magnitude = np.broadcast_to(np.asarray(magnitude, dtype=float), angle.shape)
+        return cls(np.stack((magnitude * np.cos(angle), magnitude * np.sin(angle)), axis=1))
+
+    @property
+    def x(self) -> "np.ndarray":
+        return self.data[:, 0]
+
+    @property
+    def y(self) -> "np.ndarray":
+        return self.data[:, 1]
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            x, y = self.data[index]
+            return Vec2(float(x), float(y))
+
+        return Vec2Array(self.data[index])
+
+    def __setitem__(self, index, value):
+        if isinstance(value, Vec2):
+            value = (value.x, value.y)
+        self.data[index] = _vectors(value)
+
+    def __repr__(self) -> str:
+        return f"Vec2Array({self.data!r})"
+
+    def normalized(self) -> "Vec2Array":
+        return self.copy().normalize()
+
+    def normalize(self) -> "Vec2Array":
+        self.magnitude = 1.
+        return self
+
+    def limited(self, magnitude) -> "Vec2Array":
+        return self.copy().limit(magnitude)
+
+    def limit(self, magnitude) -> "Vec2Array":
+        data = self.data
+        lengths_2 = np.einsum("ij,ij->i", data, data)
+        magnitude = np.broadcast_to(magnitude, lengths_2.shape)
+        over = (0. < magnitude * magnitude) & (magnitude * magnitude < lengths_2)
+        data[over] *= (magnitude[over] / np.sqrt(lengths_2[over]))[:, None]
+        return self
+
+    def steer(self, velocity, speed, force) -> "Vec2Array":
+        """Vec2.steer for every vector: set magnitude to speed, subtract velocity, limit to force."""
+        self.magnitude = speed
+        self.data -= _vectors(velocity)
+        return self.limit(force)
+
+    def distance_to(self, other) -> "np.ndarray":
+        return np.sqrt(self.distance_2(other))
+
+    def distance_2(self, other) -> "np.ndarray":
+        delta = _vectors(other) - self.data
+        return np.einsum("ij,ij->i", delta, delta)
+
+    def adds(self, val) -> "Vec2Array":
+        self.data += _scalars(val)
+        return self
+
+    def muls(self, val) -> "Vec2Array":
+        self.data *= _scalars(val)
+        return self
+
+    def subs(self, val) -> "Vec2Array":
+        self.data -= _scalars(val)
+        return self
+
+    def divs(self, val) -> "Vec2Array":
+        self.data /= _scalars(val)
+        return self
+
+    def add(self, other) -> "Vec2Array":
+        self.data += _vectors(other)
+        return self
+
+    def add_scaled(self, other, scale) -> "Vec2Array":
+        self.data += _vectors(other) * _scalars(scale)
+        return self
+
+    def sub(self, other) -> "Vec2Array":
+        self.data -= _vectors(other)
+        return self
+
+    subtract = sub
+
+    def mul(self, other) -> "Vec2Array":
+        self.data *= _vectors(other)
+        return self
+
+    multiply = mul
+
+    def div(self, other) -> "Vec2Array":
+        self.data /= _vectors(other)
+        return self
+
+    divide = div
+
+    def __add__(self, other) -> "Vec2Array":
+        return Vec2Array(self.data + _vectors(other))
+
+    def __iadd__(self, other) -> "Vec2Array":
+        return self.add(other)
+
+    def __sub__(self, other) -> "Vec2Array":
+        return Vec2Array(self.data - _vectors(other))
+
+    def __isub__(self, other) -> "Vec2Array":
+        return self.sub(other)
+
+    def __mul__(self, other) -> "Vec2Array":
+        return Vec2Array(self.data * _vectors(other))
+
+    def __imul__(self, other) -> "Vec2Array":
+        return self.mul(other)
+
+    def __truediv__(self, other) -> "Vec2Array":
+        return Vec2Array(self.data / _vectors(other))
+
+    def __itruediv__(self, other) -> "Vec2Array":
+        return self.div(other)
+
+    def __neg__(self) -> "Vec2Array":
+        return Vec2Array(-self.data)
+
+    @property
+    def angle(self) -> "np.ndarray":
+        return np.arctan2(self.data[:, 1], self.data[:, 0])
+
+    @property
+    def magnitude(self) -> "np.ndarray":
+        return np.hypot(self.data[:, 0], self.data[:, 1])
+
+    @magnitude.setter
+    def magnitude(self, val):
+        # Zero vectors are left alone, like Vec2's setter.
+        lengths = self.magnitude
+        val = np.broadcast_to(val, lengths.shape)
+        ratio = np.divide(val, lengths, out=np.ones_like(lengths), where=lengths > 0.)
+        self.data *= ratio[:, None]
+
+    @property
+    def magnitude_2(self) -> "np.ndarray":
+        return np.einsum("ij,ij->i", self.data, self.data)
+
+    def copy(self) -> "Vec2Array":
+        return Vec2Array(self.data.copy())
@@ -0,0 +1,184 @@
+"""
+Ticks per second against flock size, for every engine and neighbor backend.
+
+    python benchmark.py --output results.json
+    python benchmark.py --sizes 150 1000 --compare results.json
+
+Only Flock.update (or the engine's equivalent) is timed, never rendering, and every
+case is seeded the same way so two runs build identical flocks. The gpu engine runs
+in a hidden window, and each of its ticks is timed until the GPU has finished it.
+Without a display, set PYGLET_HEADLESS=1.
+"""
+import json
+import os
+import platform
+import subprocess
+from argparse import ArgumentParser
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
+
+from Flox import create_flock
+from timer import Section
+
+SIZES = 150, 500, 1000, 5000, 10000, 50000, 100000
+
+# (engine, neighbor backend) pairs. The backend only applies to the object engines.
+CASES = (
+    ("objects", "quadtree"), ("objects", "grid"),
+    ("pairs", "quadtree"), ("pairs", "grid"),
+    ("array", None), ("parallel", None), ("jit", None), ("gpu", None),
+)
+
+BOUND_RADIUS = 360.
+
+
+def commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_case(
+        engine: str, backend: Optional[str], count: int, seed: int,
+        warmup: int, ticks: int, budget: float, dt: float
+) -> Dict:
+    window = None
+    finish = None
+    if engine == "gpu":
+        # GPUFlock.update only submits the passes, so wait for them inside the timed section.
+        from gpuflock import create_context
+        from pyglet.gl import glFinish
+        window = create_context()
+        finish = glFinish
+
+    start = perf_counter()
+    flock = create_flock(count, BOUND_RADIUS, backend or "quadtree", engine, seed=seed)
+    setup = perf_counter() - start
+
+    try:
+        for _ in range(warmup):
+            flock.update(dt)
+
+        if finish is not None:
+            finish()
+
+        # Always time at least one tick, then stop at the tick limit or the time budget.
+        samples = Section("update", ticks)
+        begun = perf_counter()
+        while samples.count < ticks:
+            with samples:
+                flock.update(dt)
+                if finish is not None:
+                    finish()
+
+            if perf_counter() - begun >= budget:
+                break
+    finally:
+        close = getattr(flock, "close", None)
+        if close is not None:
+            close()
+
+        if window is not None:
+            window.close()
+
+    return {
+        "engine": engine,
+        "backend": backend,
+        "count": count,
+        "ticks": samples.count,
+        "setup_s": setup,
+        "mean_ms": samples.mean * 1000.,
+        "min_ms": samples.min * 1000.,
+        "p50_ms": samples.percentile(50.) * 1000.,
+        "p95_ms": samples.percentile(95.) * 1000.,
+        "p99_ms": samples.percentile(99.) * 1000.,
+        "max_ms": samples.max * 1000.,
+        "ticks_per_second": 1. / samples.mean,
+        "boids_per_second": count / samples.mean,
+    }
+
+
+def key(result: Dict) -> Tuple:
+    return result["engine"], result["backend"], result["count"]
+
+
+def label(result: Dict) -> str:
+    name = result["engine"] if result["backend"] is None else f"{result['engine']}/{result['backend']}"
+    return f"{name} x{result['count']}"
+
+
+def compare(results: List[Dict], baseline_path: str):
+    with open(baseline_path) as file:
+        baseline = {key(result): result for result in json.load(file)["results"] if "mean_ms" in result}
+
+    print(f"Compared with {baseline_path}:")
+    for result in results:
+        before = baseline.get(key(result))
+        if before is None or "mean_ms" not in result:
+            continue
+
+        ratio = result["mean_ms"] / before["mean_ms"]
+        print(f"    {label(result)}: {ratio:.2f}x the baseline tick time")
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark the flock update hot path.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument(
+        "--engines", nargs="+", default=sorted({engine for engine, _ in CASES}),
+        choices=sorted({engine for engine, _ in CASES})
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--warmup", type=int, default=2, help="untimed ticks before measuring")
+    parser.add_argument("--ticks", type=int, default=200, help="most timed ticks per case")
+    parser.add_argument("--budget", type=float, default=10., help="seconds of timed ticks per case")
+    parser.add_argument("--dt", type=float, default=1. / 30.)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", metavar="BASELINE", help="JSON results to compare against")
+    args = parser.parse_args()
+
+    results = []
+    for engine, backend in CASES:
+        if engine not in args.engines:
+            continue
+
+        if engine == "jit":
+            # create_flock falls back to the objects engine, which would be recorded as jit.
+            from jitflock import JIT_AVAILABLE
+            if not JIT_AVAILABLE:
+                print("Skipping jit: numba is not installed")
+                continue
+
+        for count in args.sizes:
+            result = run_case(engine, backend, count, args.seed, args.warmup, args.ticks, args.budget, args.dt)
+            results.append(result)
+            print(
+                f"{label(result)}: {result['mean_ms']:.2f}ms mean, "
+                f"{result['p95_ms']:.2f}ms p95, {result['ticks_per_second']:.1f} ticks/s "
+                f"({result['ticks']} ticks)"
+            )
+
+    report = {
+        "commit": commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "seed": args.seed,
+        "dt": args.dt,
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
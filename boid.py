@@ -1,12 +1,28 @@
-from ctypes import sizeof as size_in_memory
+from ctypes import c_float, memmove, sizeof
 from math import cos, tau, sin
-from random import random
-from typing import List
+from random import Random, getrandbits
+from time import perf_counter
+from typing import Iterator, List, Optional, Tuple, Type
+
+from quadtree import QuadTree
+from spatialhash import SpatialHash
+from recorder import Recorded
+from timer import Timer
+from vectors import Vec2
 
-from pyglet.gl import GLfloat
 
-from drawables import BoidRenderer
-from vectors import Vec2
+ORIGIN = Vec2(0., 0.)
+
+
+def seeded(seed: Optional[int] = None) -> Tuple[int, Random]:
+    """
+    A flock's own random generator and its seed. Without a seed, one is drawn
+    from `random`, so seeding `random` still reproduces a whole run.
+    """
+    if seed is None:
+        seed = getrandbits(32)
+
+    return seed, Random(seed)
 
 
 class Boid:
@@ -25,199 +41,417 @@ class Boid:
     velocity: Vec2
     acceleration: Vec2
 
-    def __init__(self, name: int, x: float, y: float):
+    def __init__(
+            self, name: int, x: float, y: float, rng: Optional[Random] = None, velocity: Optional[Vec2] = None
+    ):
+        """Without a `velocity`, the boid flies at MAX_SPEED in a direction drawn from `rng`."""
         self.name = name
         self.position = Vec2(x, y)
-        self.velocity = Vec2.from_random(self.MAX_SPEED)
+        self.velocity = Vec2.from_random(self.MAX_SPEED, rng) if velocity is None else velocity
         self.acceleration = Vec2()
 
     @property
     def heading(self) -> float:
         return self.velocity.angle
 
-    def alignment(self, neighbors: List["Boid"]) -> Vec2:
-        steering = Vec2()
-        if not len(neighbors):
-            return steering
+    def separation(self, neighbors: List["Boid"]) -> Vec2:
+        """Steering away from `neighbors`, by the inverse square of the distance to each."""
+        px = self.position.x
+        py = self.position.y
 
+        sx = sy = 0.
         total = 0
-
         for boid in neighbors:
             if boid is self:
                 continue
 
-            steering.add(boid.velocity)
-            total += 1
-
-        if total:
-            steering.divs(total)
-            steering.magnitude = self.MAX_SPEED
-            steering.subtract(self.velocity)
-            steering.limit(self.MAX_FORCE)
-
-        return steering
-
-    def cohesion(self, neighbors: List["Boid"]) -> Vec2:
-        steering = Vec2()
-        if not len(neighbors):
-            return steering
+            dx = px - boid.position.x
+            dy = py - boid.position.y
+            d2 = dx * dx + dy * dy
+            if d2:
+                dx /= d2
+                dy /= d2
 
-        total = 0
-
-        for boid in neighbors:
-            if boid is self:
-                continue
-
-            steering.add(boid.position)
+            sx += dx
+            sy += dy
             total += 1
 
-        if total:
-            steering.divs(total)
-            steering.sub(self.position)
-            steering.magnitude = self.MAX_SPEED
-            steering.subtract(self.velocity)
-            steering.limit(self.MAX_FORCE)
+        return self.flocking_forces(0., 0., 0., 0., 0, sx, sy, total)[2]
 
-        return steering
+    def flock(self, nearby: List[Tuple["Boid", float]]) -> Tuple[Vec2, Vec2, Vec2]:
+        """
+        Alignment, cohesion and separation in one pass over (neighbor, squared distance)
+        pairs, as returned by a neighbor index query within ALIGN_RANGE.
 
-    def separation(self, neighbors: List["Boid"]) -> Vec2:
-        steering = Vec2()
-        if not len(neighbors):
-            return steering
+        Every rule is applied once, in flocking_forces, which update_pairs and
+        separation share.
+        """
+        sr = self.SEPARATE_RANGE
+        sr2 = sr * sr
 
+        px = self.position.x
+        py = self.position.y
+
+        vx = vy = 0.
+        cx = cy = 0.
+        sx = sy = 0.
         total = 0
-        # for boid, d in neighbors:
-        for boid in neighbors:
+        separate_total = 0
+
+        for boid, distance in nearby:
             if boid is self:
                 continue
 
-            diff = self.position.copy()
-            diff.subtract(boid.position)
+            velocity = boid.velocity
+            position = boid.position
+            ox = position.x
+            oy = position.y
 
-            d2 = self.position.distance_2(boid.position)
+            vx += velocity.x
+            vy += velocity.y
+            cx += ox
+            cy += oy
+            total += 1
 
-            # Asking for forgiveness over permission.
-            try:
-                diff.divs(d2)
-            except ZeroDivisionError:
-                pass
+            if distance < sr2:
+                dx = px - ox
+                dy = py - oy
+
+                # Inverse square from the current positions, like separation().
+                d2 = dx * dx + dy * dy
+                if d2:
+                    dx /= d2
+                    dy /= d2
+
+                sx += dx
+                sy += dy
+                separate_total += 1
+
+        return self.flocking_forces(vx, vy, cx, cy, total, sx, sy, separate_total)
+
+    def flocking_forces(
+            self, vx: float, vy: float, cx: float, cy: float, total: int,
+            sx: float, sy: float, separate_total: int
+    ) -> Tuple[Vec2, Vec2, Vec2]:
+        """
+        Turn neighbor sums into alignment, cohesion and separation: the summed velocities
+        and positions of `total` neighbors, and the summed inverse-square offsets from
+        the `separate_total` of them that are within SEPARATE_RANGE.
+        """
+        alignment = Vec2(vx, vy)
+        cohesion = Vec2(cx, cy)
+        separation = Vec2(sx, sy)
 
-            steering.add(diff)
+        if total:
+            alignment.divs(total)
+            alignment.steer(self.velocity, self.MAX_SPEED, self.MAX_FORCE)
 
-            total += 1
+            cohesion.divs(total)
+            cohesion.sub(self.position)
+            cohesion.steer(self.velocity, self.MAX_SPEED, self.MAX_FORCE)
 
-        if total:
-            steering.divs(total)
-            steering.magnitude = self.MAX_SPEED
-            steering.subtract(self.velocity)
-            steering.limit(self.MAX_FORCE)
+        if separate_total:
+            separation.divs(separate_total)
+            separation.steer(self.velocity, self.MAX_SPEED, self.MAX_FORCE)
 
-        return steering
+        return alignment, cohesion, separation
 
     def seek(self, target: Vec2):
         steering = target.copy()
         steering.subtract(self.position)
-        steering.magnitude = self.MAX_SPEED
-        steering.subtract(self.velocity)
-        steering.limit(self.MAX_FORCE)
+        steering.steer(self.velocity, self.MAX_SPEED, self.MAX_FORCE)
 
         return steering
 
 
-class Flock:
-    def __init__(self, count: int, start: Vec2, bound_radius: float):
+def spawn(
+        count: int, start: Vec2, rng: Random, max_speed: float = Boid.MAX_SPEED
+) -> Iterator[Tuple[float, float, Vec2]]:
+    """
+    Position and velocity of `count` new boids, spread around a circle about
+    `start` and flying in random directions. Every engine starts its boids from
+    here, so flocks with the same seed start identically whatever the engine.
+    """
+    for _ in range(count):
+        angle = rng.random() * tau
+        yield 100.0 * cos(angle) + start.x, 100.0 * sin(angle) + start.y, Vec2.from_random(max_speed, rng)
+
+
+class Flock(Recorded):
+    BACKENDS = "quadtree", "grid"
+
+    def __init__(
+            self, count: int, start: Vec2, bound_radius: float, backend: str = "quadtree",
+            timer: Optional[Timer] = None, pairwise: bool = False, seed: Optional[int] = None,
+            boid_type: Type[Boid] = Boid
+    ):
+        """`boid_type` is the Boid subclass, and so the parameters, every boid of the flock is made with."""
         self.bound = bound_radius
+        self.timer = timer
+        self.backend = backend
+        self.pairwise = pairwise
         self.count = count
-        self.data: List[Boid] = [
-            Boid(name, 100.0 * cos(angle) + start.x, 100.0 * sin(angle) + start.y)
+        self.boid_type = boid_type
 
-            # pretty cool, these two will be evaluated as they're needed.
-            for name, angle in zip(range(count), (random() * tau for _ in range(count)))
+        # Every random draw the flock makes comes from here.
+        self.seed, self.random = seeded(seed)
+        self.data: List[Boid] = [
+            boid_type(name, x, y, velocity=velocity)
+            for name, (x, y, velocity) in enumerate(spawn(count, start, self.random, boid_type.MAX_SPEED))
         ]
-        self.distances = [([0.] * count) for _ in range(count)]
-        self.renderer = BoidRenderer()
 
-    def update(self, dt: float):
-        boid_data = (GLfloat * (3 * self.count))()
-        for i in range(self.count):
-            boid = self.data[i]
+        if backend == "quadtree":
+            self.index = QuadTree()
+        elif backend == "grid":
+            # One cell per alignment range, so a query only touches the 3x3 block around a boid.
+            self.index = SpatialHash(boid_type.ALIGN_RANGE)
+        else:
+            raise ValueError(f"Unknown neighbor backend {backend!r}, expected one of {self.BACKENDS}")
+
+        self.next_name = count
+
+        # (x, y, boid) for every boid at the start of the current tick.
+        self.snapshot: List[Tuple[float, float, Boid]] = []
+
+        # Interleaved x, y, heading per boid, in the layout BoidRenderer uploads.
+        # Rewritten in place every tick, and only reallocated when the flock outgrows it.
+        self.boid_data = (c_float * (3 * count))()
+
+    def add(self, x: float, y: float) -> Boid:
+        """Add a boid at (x, y), flying in a random direction."""
+        boid = self.boid_type(self.next_name, x, y, self.random)
+        self.next_name += 1
 
-            # TODO: Replace this distances array with a Quad-Tree data structure.
-            for j in range(i + 1, self.count):
-                other = self.data[j]
+        index = self.count
+        self.reserve(index + 1)
+        self.data.append(boid)
+        self.count += 1
 
-                distance = boid.position.distance_2(other.position)
+        boid_data = self.boid_data
+        boid_data[3 * index + 0] = boid.position.x
+        boid_data[3 * index + 1] = boid.position.y
+        boid_data[3 * index + 2] = boid.heading
 
-                self.distances[i][j] = distance
-                self.distances[j][i] = distance
+        return boid
 
+    def remove(self, index: int) -> Boid:
+        """Remove the boid at `index`, moving the last boid into its place."""
+        if not 0 <= index < self.count:
+            raise IndexError(f"Flock index {index} out of range for {self.count} boids")
+
+        data = self.data
+        boid = data[index]
+
+        last = data.pop()
+        self.count -= 1
+        if index < self.count:
+            data[index] = last
+            boid_data = self.boid_data
+            end = 3 * self.count
+            boid_data[3 * index:3 * index + 3] = boid_data[end:end + 3]
+
+        return boid
+
+    def reserve(self, count: int):
+        """Make room in boid_data for `count` boids, at least doubling it so growing is amortized O(1)."""
+        capacity = len(self.boid_data) // 3
+        if count <= capacity:
+            return
+
+        boid_data = (c_float * (3 * max(count, 2 * capacity)))()
+        memmove(boid_data, self.boid_data, sizeof(self.boid_data))
+        self.boid_data = boid_data
+
+    def update(self, dt: float):
+        if self.pairwise:
+            self.update_pairs(dt)
+        else:
+            self.update_boids(dt)
+
+    def update_boids(self, dt: float):
+        """
+        Step in two phases over a snapshot. Every boid moves first, using only its
+        own state, then every boid steers from the moved flock, changing only its own
+        acceleration. No boid sees another half way through the tick, so the result
+        does not depend on the order of the boids or on how steer_range splits them.
+        """
+        clock = perf_counter
+        start = clock()
+
+        self.take_snapshot()
+
+        rebuilt = clock()
+        self.integrate(dt)
+        integrated = clock()
+
+        neighbors_time, steering_time = self.steer_range(0, self.count)
+
+        self.record(
+            index=rebuilt - start, neighbors=neighbors_time, integration=integrated - rebuilt, steering=steering_time
+        )
+
+    def take_snapshot(self):
+        """Record where every boid starts the tick, and index them there."""
+        self.snapshot = [(boid.position.x, boid.position.y, boid) for boid in self.data]
+        self.index.rebuild(self.snapshot)
+
+    def integrate(self, dt: float):
+        for boid in self.data:
             # ****** Update Boids ******
             boid.velocity += boid.acceleration
             # boid.velocity.magnitude = boid.MAX_SPEED
-            boid.position += boid.velocity * Vec2(dt, dt)
+            boid.position.add_scaled(boid.velocity, dt)
 
             # reset acceleration
             boid.acceleration.muls(0.)
 
-            # stay near the origin
-            origin = Vec2(0., 0.)
-            distance_to_origin = boid.position.distance_2(origin)
-            bound = self.bound
-            if distance_to_origin > bound * bound:
-                origin_seek = boid.seek(origin)
-                origin_seek.divs(1.5)
-                boid.acceleration += origin_seek
-
-            speed_up = boid.velocity.copy()
-            speed_up.magnitude = boid.MAX_SPEED
-            speed_up.subtract(boid.velocity)
-            # speed_up.limit(boid.MAX_FORCE)
-            speed_up.limit(boid.MAX_FORCE / 2)
-            boid.acceleration.add(speed_up)
-
-            # **** Alignment and Cohesion ****
-            ar = boid.ALIGN_RANGE
-            aclign_to = []
-            for j, other in enumerate(self.data):
-                if other is boid:
-                    continue
-
-                dist = self.distances[i][j]
-                if dist < ar * ar:
-                    aclign_to.append(other)
-
-            alignment = boid.alignment(aclign_to)
-            cohesion = boid.cohesion(aclign_to)
-
-            # **** Separation ****
+    def steer_range(self, begin: int, end: int) -> Tuple[float, float]:
+        """
+        Steer boids [begin, end) of an integrated flock. Any split of the boids into
+        ranges, run in any order, gives the same flock as one call over all of them.
+
+        Returns the time spent finding neighbors and steering.
+        """
+        # Phase times are summed over the boid loop with bare perf_counter
+        # calls, which is cheap enough to leave on all the time.
+        clock = perf_counter
+        neighbors_time = steering_time = 0.
+
+        snapshot = self.snapshot
+        query = self.index.query
+        ar = self.boid_type.ALIGN_RANGE
+        for i in range(begin, end):
+            x, y, boid = snapshot[i]
+            before = clock()
+
+            # ****** Neighbors ******
+            # Found between start of tick positions. Their velocities and positions are
+            # then read from the integrated flock, which steering never changes.
+            nearby = query(x, y, ar)
+
+            gathered = clock()
+
             # FIXME: This separation code is causing the boids to jitter. Why?
-            sr = boid.SEPARATE_RANGE
-            separate_from = []
-            for j, other in enumerate(self.data):
-                if other is boid:
-                    continue
-
-                dist = self.distances[i][j]
-                if dist < sr * sr:
-                    separate_from.append(other)
-            separation = boid.separation(separate_from)
-
-            # alignment.divs(8.)
-            alignment.divs(4.)
-            cohesion.divs(16.)
-            separation.divs(2.)
-
-            boid.acceleration.add(alignment)
-            boid.acceleration.add(cohesion)
-            boid.acceleration.add(separation)
-
-            # ****** Update Drawable Shape ******
-            index = i * 3
-            boid_data[index + 0] = boid.position.x
-            boid_data[index + 1] = boid.position.y
-            boid_data[index + 2] = boid.heading
-
-        self.renderer.update(boid_data, size_in_memory(boid_data))
-
-    def draw(self):
-        self.renderer.draw(self.count)
+            self.steer(i, boid, *boid.flock(nearby))
+
+            after = clock()
+            neighbors_time += gathered - before
+            steering_time += after - gathered
+
+        return neighbors_time, steering_time
+
+    def update_pairs(self, dt: float):
+        """
+        Visit every pair of boids within ALIGN_RANGE once, adding each one's
+        contribution to both boids, then turn the sums into forces.
+        """
+        clock = perf_counter
+        start = clock()
+
+        data = self.data
+        count = self.count
+
+        # Neighbors are found from the positions at the start of the tick.
+        self.index.rebuild((boid.position.x, boid.position.y, i) for i, boid in enumerate(data))
+
+        rebuilt = clock()
+
+        # Every boid moves before any pair is visited, so both sides of
+        # a pair see the same state.
+        self.integrate(dt)
+
+        integrated = clock()
+
+        vx = [0.] * count
+        vy = [0.] * count
+        cx = [0.] * count
+        cy = [0.] * count
+        sx = [0.] * count
+        sy = [0.] * count
+        total = [0] * count
+        separate_total = [0] * count
+
+        sr = self.boid_type.SEPARATE_RANGE
+        sr2 = sr * sr
+        for i, j, distance in self.index.pairs(self.boid_type.ALIGN_RANGE):
+            a_position = data[i].position
+            a_velocity = data[i].velocity
+            b_position = data[j].position
+            b_velocity = data[j].velocity
+
+            vx[i] += b_velocity.x
+            vy[i] += b_velocity.y
+            vx[j] += a_velocity.x
+            vy[j] += a_velocity.y
+
+            ax = a_position.x
+            ay = a_position.y
+            bx = b_position.x
+            by = b_position.y
+
+            cx[i] += bx
+            cy[i] += by
+            cx[j] += ax
+            cy[j] += ay
+
+            total[i] += 1
+            total[j] += 1
+
+            if distance < sr2:
+                # Inverse square from the current positions, like Boid.flock.
+                dx = ax - bx
+                dy = ay - by
+                d2 = dx * dx + dy * dy
+                if d2:
+                    dx /= d2
+                    dy /= d2
+
+                sx[i] += dx
+                sy[i] += dy
+                sx[j] -= dx
+                sy[j] -= dy
+
+                separate_total[i] += 1
+                separate_total[j] += 1
+
+        gathered = clock()
+
+        for i, boid in enumerate(data):
+            forces = boid.flocking_forces(vx[i], vy[i], cx[i], cy[i], total[i], sx[i], sy[i], separate_total[i])
+            self.steer(i, boid, *forces)
+
+        self.record(
+            index=rebuilt - start, neighbors=gathered - integrated, integration=integrated - rebuilt,
+            steering=clock() - gathered
+        )
+
+    def steer(self, i: int, boid: Boid, alignment: Vec2, cohesion: Vec2, separation: Vec2):
+        """Set the acceleration of an integrated boid and write its render state."""
+        # stay near the origin
+        distance_to_origin = boid.position.magnitude_2
+        bound = self.bound
+        if distance_to_origin > bound * bound:
+            origin_seek = boid.seek(ORIGIN)
+            origin_seek.divs(1.5)
+            boid.acceleration.add(origin_seek)
+
+        speed_up = boid.velocity.copy()
+        # speed_up.steer(boid.velocity, boid.MAX_SPEED, boid.MAX_FORCE)
+        speed_up.steer(boid.velocity, boid.MAX_SPEED, boid.MAX_FORCE / 2)
+        boid.acceleration.add(speed_up)
+
+        # alignment.divs(8.)
+        alignment.divs(4.)
+        cohesion.divs(16.)
+        separation.divs(2.)
+
+        boid.acceleration.add(alignment)
+        boid.acceleration.add(cohesion)
+        boid.acceleration.add(separation)
+
+        # ****** Update Drawable Shape ******
+        boid_data = self.boid_data
+        index = i * 3
+        boid_data[index + 0] = boid.position.x
+        boid_data[index + 1] = boid.position.y
+        boid_data[index + 2] = boid.heading
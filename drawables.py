@@ -1,9 +1,12 @@
 import ctypes as c
 from math import sin, cos, pi
+from typing import List, Optional, Sequence, Tuple
 
+import numpy as np
 from pyglet.gl import *
 
-from shader import Shader, World
+from limits import MAX_SPECIES
+from shader import Alpha, Mat4, UniformBuffer, get_shader, projection
 
 
 class BoidRenderer:
@@ -13,46 +16,174 @@ class BoidRenderer:
     layout(location = 0) in vec4 position;
     layout(location = 1) in vec2 offset;
     layout(location = 2) in float angle;
+    layout(location = 3) in vec2 previous_offset;
+    layout(location = 4) in float previous_angle;
+    layout(location = 5) in uint species;
+
+    layout(std140) uniform View {
+        mat4 u_Projection;
+    };
 
-    uniform mat4 u_Projection = mat4(1.0);
     uniform float u_Scale = 10.0;
 
+    flat out uint v_Species;
+
+    // How far the frame is between the previous and the current simulation tick.
+    uniform float u_Alpha = 1.0;
+
+    const float PI = 3.14159265359;
+
     void main() {
-        float sa = u_Scale * sin(angle);
-        float ca = u_Scale * cos(angle);
+        v_Species = species;
+        vec2 center = mix(previous_offset, offset, u_Alpha);
+
+        // Turn the short way round, so headings either side of +-pi don't spin.
+        float turn = mod(angle - previous_angle + PI, 2.0 * PI) - PI;
+        float heading = previous_angle + turn * u_Alpha;
+
+        float sa = u_Scale * sin(heading);
+        float ca = u_Scale * cos(heading);
         mat4 model = mat4(
             ca,       sa,       0.0, 0.0,
             -sa,      ca,       0.0, 0.0,
             0.0,      0.0,      1.0, 0.0,
-            offset.x, offset.y, 0.0, 1.0
+            center.x, center.y, 0.0, 1.0
         );
     
         gl_Position = u_Projection * model * position;
     }
     """
 
+    # Level of detail for boids smaller than LOD_PIXELS: one point each, at the same place.
+    # language=GLSL
+    point_vertex = b"""
+    #version 330 core
+    layout(location = 1) in vec2 offset;
+    layout(location = 3) in vec2 previous_offset;
+    layout(location = 5) in uint species;
+
+    layout(std140) uniform View {
+        mat4 u_Projection;
+    };
+
+    uniform float u_Alpha = 1.0;
+
+    flat out uint v_Species;
+
+    void main() {
+        v_Species = species;
+        gl_Position = u_Projection * vec4(mix(previous_offset, offset, u_Alpha), 0.0, 1.0);
+    }
+    """
+
+    # Every boid is coloured by its species, a flock without species being all species 0.
     # language=GLSL
     fragment = b"""
     #version 330 core
 
+    // MAX_SPECIES colours, padded to vec4s by std140.
+    layout(std140) uniform Palette {
+        vec4 u_Colors[%d];
+    };
+
+    flat in uint v_Species;
+
     layout(location = 0) out vec4 color;
 
     void main() {
-        color = vec4(1.0, 0.4, 0.2, 1.0);
+        color = vec4(u_Colors[v_Species].rgb, 1.0);
     }
-    """
+    """ % MAX_SPECIES
 
     scale = 10.0
 
-    __slots__ = "shader", "_buffer_array", "_model_buffer", "_offset_buffer", "_index_buffer"
+    COLORS = (1.0, 0.4, 0.2),
+
+    # Uniform buffer binding points of the View and Palette blocks.
+    VIEW_BINDING = 0
+    PALETTE_BINDING = 1
+
+    # Boids drawn smaller than this many pixels across are drawn as points.
+    LOD_PIXELS = 3.
+
+    # Slots in the ring. A draw reads the newest, so the others are free to write.
+    RING = 3
+
+    # Bytes per boid in a tick: x, y, heading.
+    STRIDE = 3 * c.sizeof(GLfloat)
+
+    # Longest wait for the GPU to release a ring buffer, in nanoseconds.
+    STALL_TIMEOUT = 1_000_000_000
+
+    __slots__ = (
+        "shader", "alpha", "point_shader", "point_alpha", "view", "zoom", "stalls", "_uploads", "_capacity",
+        "_vertex_arrays", "_model_buffer", "_ring", "_fences", "_index_buffer", "palette",
+        "_ticks", "_species", "_count", "_visible", "_bounds", "_on_gpu"
+    )
+
+    alpha: Alpha
+    point_alpha: Alpha
+    # The projection and the species colours, shared by both programs through their View and Palette blocks.
+    view: UniformBuffer
+    palette: UniformBuffer
+
+    # Screen pixels per world unit.
+    zoom: float
+
+    # Uploads that had to wait for the GPU to finish drawing from the buffer they were writing.
+    stalls: int
 
-    _buffer_array: GLuint
+    _uploads: int
+
+    # Boids each ring slot holds.
+    _capacity: int
+
+    _vertex_arrays: List[GLuint]
     _model_buffer: GLuint
-    _offset_buffer: GLuint
+    _ring: List[GLuint]
+    _fences: List[Optional[GLsync]]
     _index_buffer: GLuint
 
+    # The newest tick and the one before it, (capacity, 3) each, kept to cull against the view.
+    _ticks: Tuple[np.ndarray, np.ndarray]
+
+    # One species byte per boid, once set_species has been called.
+    _species: Optional[np.ndarray]
+
+    # Boids in the newest tick, and how many of them are in the newest slot.
+    _count: int
+    _visible: int
+
+    # Half the view's width and height in world units, widened by a boid's size.
+    _bounds: Tuple[float, float]
+
+    # Whether the newest slot was copied from a GL buffer, uncut, rather than culled from _ticks.
+    _on_gpu: bool
+
     def __init__(self, max_boids=256):
-        self.shader = Shader(self.vertex, self.fragment)
+        self.shader = get_shader(self.vertex, self.fragment)
+        self.alpha = Alpha(self.shader)
+        self.point_shader = get_shader(self.point_vertex, self.fragment)
+        self.point_alpha = Alpha(self.point_shader)
+
+        self.view = UniformBuffer(self.VIEW_BINDING, c.sizeof(Mat4))
+        self.view.attach(self.shader, b"View")
+        self.view.attach(self.point_shader, b"View")
+
+        self.palette = UniformBuffer(self.PALETTE_BINDING, MAX_SPECIES * 4 * c.sizeof(GLfloat))
+        self.palette.attach(self.shader, b"Palette")
+        self.palette.attach(self.point_shader, b"Palette")
+        self.set_colors(self.COLORS)
+
+        self.stalls = 0
+        self._uploads = 0
+        self._capacity = max(1, max_boids)
+        self._ticks = np.zeros((self._capacity, 3), np.float32), np.zeros((self._capacity, 3), np.float32)
+        self._species = None
+        self._count = 0
+        self._visible = 0
+        self._on_gpu = False
+        self.set_world(2, 2)
 
         indices = (GLuint * 10)(0, 1, 1, 3, 3, 0, 1, 2, 2, 3)
         positions = (GLfloat * 8)(
@@ -62,14 +193,7 @@ class BoidRenderer:
             0.5 * cos(pi),   0.5 * sin(pi)
         )
 
-        self._buffer_array = GLuint(0)
         self._model_buffer = GLuint(0)
-        self._offset_buffer = GLuint(0)
-        self._index_buffer = GLuint(0)
-
-        glGenVertexArrays(1, c.byref(self._buffer_array))
-        glBindVertexArray(self._buffer_array)
-
         glGenBuffers(1, c.byref(self._model_buffer))
         glBindBuffer(GL_ARRAY_BUFFER, self._model_buffer)
 
@@ -78,33 +202,76 @@ class BoidRenderer:
             positions, GL_STATIC_DRAW
         )
 
+        self._index_buffer = GLuint(0)
+        glGenBuffers(1, c.byref(self._index_buffer))
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self._index_buffer)
+        glBufferData(
+            GL_ELEMENT_ARRAY_BUFFER, c.sizeof(indices),
+            indices, GL_STATIC_DRAW
+        )
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+
+        self._ring = [self._create_buffer(self._slot_size(self._capacity)) for _ in range(self.RING)]
+        self._fences = [None] * self.RING
+        self._vertex_arrays = []
+        self._create_vertex_arrays()
+
+        # Without species, the species attribute reads this constant instead.
+        glVertexAttribI4ui(5, 0, 0, 0, 0)
+
+    @classmethod
+    def _slot_size(cls, capacity: int) -> int:
+        """A slot holds `capacity` boids of the newest tick, then of the tick before, then their species bytes."""
+        return capacity * (2 * cls.STRIDE + 1)
+
+    @staticmethod
+    def _create_buffer(size: int) -> GLuint:
+        buffer = GLuint(0)
+        glGenBuffers(1, c.byref(buffer))
+        glBindBuffer(GL_COPY_WRITE_BUFFER, buffer)
+        glBufferData(GL_COPY_WRITE_BUFFER, size, None, GL_STREAM_DRAW)
+        glBindBuffer(GL_COPY_WRITE_BUFFER, 0)
+
+        return buffer
+
+    def _create_vertex_arrays(self):
+        # One vertex array per ring slot, so a draw only has to pick one instead of re-pointing the attributes.
+        for vertex_array in self._vertex_arrays:
+            glDeleteVertexArrays(1, c.byref(vertex_array))
+
+        self._vertex_arrays = [self._create_vertex_array(buffer) for buffer in self._ring]
+
+    def _create_vertex_array(self, buffer: GLuint) -> GLuint:
+        vertex_array = GLuint(0)
+        glGenVertexArrays(1, c.byref(vertex_array))
+        glBindVertexArray(vertex_array)
+
+        glBindBuffer(GL_ARRAY_BUFFER, self._model_buffer)
         glEnableVertexAttribArray(0)
         glVertexAttribPointer(0, 2, GL_FLOAT, GL_FALSE, 2 * c.sizeof(GLfloat), None)
 
-        glGenBuffers(1, c.byref(self._offset_buffer))
-        glBindBuffer(GL_ARRAY_BUFFER, self._offset_buffer)
+        # x, y, heading per boid, for this tick at 1 and 2 and the tick before at 3 and 4.
+        glBindBuffer(GL_ARRAY_BUFFER, buffer)
+        for location, offset in ((1, 0), (3, self._capacity * self.STRIDE)):
+            glEnableVertexAttribArray(location)
+            glVertexAttribPointer(location, 2, GL_FLOAT, GL_FALSE, 3 * c.sizeof(GLfloat), c.c_void_p(offset))
+            glVertexAttribDivisor(location, 1)
 
-        glBufferData(GL_ARRAY_BUFFER, (3 * c.sizeof(GLfloat)) * max_boids, None, GL_STREAM_DRAW)
+            glEnableVertexAttribArray(location + 1)
+            glVertexAttribPointer(
+                location + 1, 1, GL_FLOAT, GL_FALSE, 3 * c.sizeof(GLfloat),
 
-        glEnableVertexAttribArray(1)
-        glVertexAttribPointer(1, 2, GL_FLOAT, GL_FALSE, 3 * c.sizeof(GLfloat), None)
-        glVertexAttribDivisor(1, 1)
+                # weird offset thing
+                c.c_void_p(offset + 2 * c.sizeof(GLfloat))
+            )
+            glVertexAttribDivisor(location + 1, 1)
 
-        glEnableVertexAttribArray(2)
-        glVertexAttribPointer(
-            2, 1, GL_FLOAT, GL_FALSE, 3 * c.sizeof(GLfloat),
-
-            # weird offset thing
-            c.c_void_p(2 * c.sizeof(GLfloat))
-        )
-        glVertexAttribDivisor(2, 1)
+        if self._species is not None:
+            glEnableVertexAttribArray(5)
+            glVertexAttribIPointer(5, 1, GL_UNSIGNED_BYTE, 1, c.c_void_p(2 * self._capacity * self.STRIDE))
+            glVertexAttribDivisor(5, 1)
 
-        glGenBuffers(1, c.byref(self._index_buffer))
         glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self._index_buffer)
-        glBufferData(
-            GL_ELEMENT_ARRAY_BUFFER, c.sizeof(indices),
-            indices, GL_STATIC_DRAW
-        )
 
         # We have to unbind the vertex array first.
         # Otherwise the other buffers will be disassociated
@@ -113,20 +280,284 @@ class BoidRenderer:
         glBindBuffer(GL_ARRAY_BUFFER, 0)
         glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
 
-    def set_world(self, width: int, height: int):
-        World(self.shader).set(width, height)
+        return vertex_array
+
+    def set_world(self, width: int, height: int, zoom: float = 1.):
+        self.zoom = zoom
+        # One upload for both programs.
+        self.view.update(Mat4(*projection(width, height, zoom)))
+
+        # A boid reaches `scale` from its center.
+        self._bounds = width / 2 / zoom + self.scale, height / 2 / zoom + self.scale
+        if self._uploads and not self._on_gpu:
+            # Other boids are in view now.
+            self._upload()
+
+    def set_colors(self, colors: Sequence[Tuple[float, float, float]]):
+        """The red, green, blue colour of every species, by species number."""
+        if len(colors) > MAX_SPECIES:
+            raise ValueError(f"At most {MAX_SPECIES} species can be drawn, not {len(colors)}")
+
+        # std140 pads every vec3 of the array to a vec4.
+        self.palette.update((GLfloat * (4 * len(colors)))(*(channel for r, g, b in colors for channel in (r, g, b, 1.))))
+
+    def set_species(self, data: c.Array, count: int):
+        """
+        Give each of the first `count` boids a species, one byte each, so a whole
+        Scene is drawn in one call. Only needed when the boids change, not per tick.
+        """
+        self.reserve(count)
+        if self._species is None:
+            self._species = np.zeros(self._capacity, np.uint8)
+            self._create_vertex_arrays()
+
+        self._species[:count] = np.frombuffer(data, np.uint8, count)
+
+    @property
+    def _current(self) -> int:
+        return (self._uploads - 1) % self.RING
+
+    def reserve(self, count: int):
+        """
+        Make room for `count` boids. The ring buffers at least double when they
+        grow, so a growing flock reallocates them O(log n) times, not every tick.
+        """
+        if count <= self._capacity:
+            return
+
+        capacity = max(count, 2 * self._capacity)
+        ticks = []
+        for tick in self._ticks:
+            grown = np.zeros((capacity, 3), np.float32)
+            grown[:self._count] = tick[:self._count]
+            ticks.append(grown)
+
+        self._ticks = tuple(ticks)
+        if self._species is not None:
+            self._species = np.concatenate((self._species, np.zeros(capacity - self._capacity, np.uint8)))
+
+        kept = self._visible * self.STRIDE
+        newest = self._ring[self._current]
+        ring = [self._create_buffer(self._slot_size(capacity)) for _ in range(self.RING)]
+        if self._uploads and self._on_gpu and kept:
+            # copy_from interpolates from the newest slot, so keep both of its ticks. Culled ticks are
+            # uploaded again from _ticks anyway.
+            glBindBuffer(GL_COPY_READ_BUFFER, newest)
+            glBindBuffer(GL_COPY_WRITE_BUFFER, ring[self._current])
+            glCopyBufferSubData(GL_COPY_READ_BUFFER, GL_COPY_WRITE_BUFFER, 0, 0, kept)
+            glCopyBufferSubData(
+                GL_COPY_READ_BUFFER, GL_COPY_WRITE_BUFFER,
+                self._capacity * self.STRIDE, capacity * self.STRIDE, kept
+            )
+            glBindBuffer(GL_COPY_READ_BUFFER, 0)
+            glBindBuffer(GL_COPY_WRITE_BUFFER, 0)
+
+        # GL holds on to the storage until the draws reading it are done.
+        for buffer in self._ring:
+            glDeleteBuffers(1, c.byref(buffer))
+
+        # Nothing has drawn from the new buffers yet.
+        for slot in range(self.RING):
+            self._release(slot)
+
+        self._ring = ring
+        self._capacity = capacity
+        self._create_vertex_arrays()
 
     def update(self, data: c.Array, size: int):
-        glBindVertexArray(self._buffer_array)
-        glBindBuffer(GL_ARRAY_BUFFER, self._offset_buffer)
+        """
+        Upload a new simulation tick. The tick being replaced becomes the previous
+        one. Only the boids in view in either tick are uploaded and drawn.
+        """
+        count = size // self.STRIDE
+        self.reserve(count)
 
-        glBufferSubData(GL_ARRAY_BUFFER, 0, size, data)
+        previous, current = self._ticks
+        current[:count] = np.frombuffer(data, np.float32, 3 * count).reshape(count, 3)
 
-        glBindVertexArray(0)
-        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        # Boids added since the last tick start where they are, with nothing to interpolate from.
+        kept = min(self._count, count) if self._uploads and not self._on_gpu else 0
+        previous[kept:count] = current[kept:count]
+
+        self._ticks = current, previous
+        self._count = count
+        self._on_gpu = False
+        self._upload()
+
+    def _upload(self):
+        """Cull the newest two ticks against the view, and write the boids left into the next slot."""
+        count = self._count
+        current, previous = self._ticks[0][:count], self._ticks[1][:count]
+        width, height = self._bounds
+
+        # A boid moves far less than its size in a tick, so if it is out of view at both ends it
+        # is out of view in between.
+        visible = (
+            (np.abs(current[:, 0]) <= width) & (np.abs(current[:, 1]) <= height) |
+            (np.abs(previous[:, 0]) <= width) & (np.abs(previous[:, 1]) <= height)
+        )
+        sections = [current, previous]
+        if self._species is not None:
+            sections.append(self._species[:count])
+
+        if not visible.all():
+            # The same boids, in the same order, in every section.
+            indices = np.flatnonzero(visible)
+            sections = [section.take(indices, axis=0) for section in sections]
+
+        self._claim()
+        slot = self._current
+        self._visible = len(sections[0])
+        if not self._visible:
+            return
+
+        self._wait(slot)
+        glBindBuffer(GL_COPY_WRITE_BUFFER, self._ring[slot])
+        # The fence said the GPU is done with this buffer, so skip the driver's own check.
+        pointer = glMapBufferRange(
+            GL_COPY_WRITE_BUFFER, 0, self._slot_size(self._capacity),
+            GL_MAP_WRITE_BIT | GL_MAP_INVALIDATE_RANGE_BIT | GL_MAP_UNSYNCHRONIZED_BIT
+        )
+        offsets = 0, self._capacity * self.STRIDE, 2 * self._capacity * self.STRIDE
+        for offset, section in zip(offsets, sections):
+            c.memmove(pointer + offset, np.ascontiguousarray(section).ctypes.data, section.nbytes)
+
+        glUnmapBuffer(GL_COPY_WRITE_BUFFER)
+        glBindBuffer(GL_COPY_WRITE_BUFFER, 0)
+
+    def copy_from(self, buffer: GLuint, size: int):
+        """
+        Like update, but the new tick is already in a GL buffer, such as a GPUFlock's
+        render_buffer. Every boid is drawn: culling would mean reading the tick back.
+        """
+        count = size // self.STRIDE
+        self.reserve(count)
+
+        kept = min(self._visible, count) * self.STRIDE if self._uploads and self._on_gpu else 0
+        newest = self._ring[self._current]
+        self._claim()
+        target = self._ring[self._current]
+        previous = self._capacity * self.STRIDE
+        if size:
+            # Copies run in order with the draws on the GPU, so they never wait on a fence.
+            glBindBuffer(GL_COPY_WRITE_BUFFER, target)
+            glBindBuffer(GL_COPY_READ_BUFFER, buffer)
+            glCopyBufferSubData(GL_COPY_READ_BUFFER, GL_COPY_WRITE_BUFFER, 0, 0, size)
+            if kept < size:
+                # Boids added since the last tick start where they are.
+                glCopyBufferSubData(GL_COPY_READ_BUFFER, GL_COPY_WRITE_BUFFER, kept, previous + kept, size - kept)
+
+            if kept:
+                # The tick before is the newest slot's tick.
+                glBindBuffer(GL_COPY_READ_BUFFER, newest)
+                glCopyBufferSubData(GL_COPY_READ_BUFFER, GL_COPY_WRITE_BUFFER, 0, previous, kept)
+
+            if self._species is not None:
+                glBufferSubData(
+                    GL_COPY_WRITE_BUFFER, 2 * previous, count, self._species.ctypes.data_as(c.c_void_p)
+                )
+
+            glBindBuffer(GL_COPY_READ_BUFFER, 0)
+            glBindBuffer(GL_COPY_WRITE_BUFFER, 0)
+
+        self._count = self._visible = count
+        self._on_gpu = True
+
+    def remove(self, index: int):
+        """
+        Mirror a flock's swap removal, moving the last boid into `index`, in the
+        newest two ticks. Without it that boid would appear to fly from the removed
+        boid's place for one tick.
+        """
+        last = self._count - 1
+        if not self._uploads or not 0 <= index <= last:
+            return
+
+        if not self._on_gpu:
+            arrays = list(self._ticks)
+            if self._species is not None:
+                arrays.append(self._species)
+
+            for array in arrays:
+                array[index] = array[last]
+
+            self._count = last
+            self._upload()
+            return
+
+        if index < last:
+            # Uncut, so the boid at `index` is at `index` in the slot too.
+            buffer = self._ring[self._current]
+            glBindBuffer(GL_COPY_READ_BUFFER, buffer)
+            glBindBuffer(GL_COPY_WRITE_BUFFER, buffer)
+            for start in (0, self._capacity * self.STRIDE):
+                glCopyBufferSubData(
+                    GL_COPY_READ_BUFFER, GL_COPY_WRITE_BUFFER,
+                    start + last * self.STRIDE, start + index * self.STRIDE, self.STRIDE
+                )
+
+            glBindBuffer(GL_COPY_READ_BUFFER, 0)
+            glBindBuffer(GL_COPY_WRITE_BUFFER, 0)
+
+        self._count = self._visible = last
+
+    def reset(self):
+        """Forget the uploaded ticks, so the next one is drawn without interpolating from them."""
+        self._uploads = 0
+        self._count = 0
+        self._visible = 0
+
+    @property
+    def capacity(self) -> int:
+        """Most boids the ring buffers hold before they have to grow."""
+        return self._capacity
+
+    @property
+    def visible(self) -> int:
+        """Boids the next draw draws: those in view, unless the tick came from a GL buffer."""
+        return self._visible if self._uploads else 0
+
+    def _claim(self):
+        """Advance the ring to the slot the new tick is written to."""
+        self._uploads += 1
+
+    def _wait(self, slot: int):
+        fence = self._fences[slot]
+        if fence is None:
+            return
+
+        if glClientWaitSync(fence, 0, 0) == GL_TIMEOUT_EXPIRED:
+            self.stalls += 1
+            glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT, self.STALL_TIMEOUT)
+
+        self._release(slot)
+
+    def _release(self, slot: int):
+        fence = self._fences[slot]
+        self._fences[slot] = None
+        if fence is not None:
+            glDeleteSync(fence)
+
+    def draw(self, alpha: float = 1.):
+        """Draw the boids in view, `alpha` of the way from the previous tick to the current one."""
+        count = self.visible
+        if not count:
+            return
+
+        current = self._current
+        if self.scale * self.zoom < self.LOD_PIXELS:
+            # Too small to make out a shape: one vertex per boid instead of ten.
+            with self.point_shader:
+                self.point_alpha.set(alpha)
+                glBindVertexArray(self._vertex_arrays[current])
+                glDrawArraysInstanced(GL_POINTS, 0, 1, count)
+                glBindVertexArray(0)
+        else:
+            with self.shader:
+                self.alpha.set(alpha)
+                glBindVertexArray(self._vertex_arrays[current])
+                glDrawElementsInstanced(GL_LINES, 10, GL_UNSIGNED_INT, None, count)
+                glBindVertexArray(0)
 
-    def draw(self, count: int):
-        with self.shader:
-            glBindVertexArray(self._buffer_array)
-            glDrawElementsInstanced(GL_LINES, 10, GL_UNSIGNED_INT, None, count)
-            glBindVertexArray(0)
+        self._release(current)
+        self._fences[current] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
@@ -0,0 +1,489 @@
+"""
+Flock stepped entirely on the GPU with transform feedback.
+
+Needs a current OpenGL 3.3 context. To check it against the CPU engine without a
+display, for example under Mesa's llvmpipe:
+
+    PYGLET_HEADLESS=1 python gpuflock.py --count 64 --ticks 30
+"""
+import ctypes as c
+from argparse import ArgumentParser
+from time import perf_counter
+from typing import List, Optional, Tuple
+
+import numpy as np
+from pyglet.gl import *
+
+from boid import Boid, seeded, spawn
+from recorder import Recorded
+from shader import Shader
+from timer import Timer
+from vectors import Vec2
+
+
+class GPUFlock(Recorded):
+    """
+    Follows the same rules as ArrayFlock, but keeps every boid in GL buffers.
+
+    Each tick is two passes with rasterization off. The first integrates the
+    positions and velocities from one pair of buffers into the other, the second
+    reads every boid back through buffer textures to set the accelerations and
+    fill render_buffer. Then the pairs swap, so the CPU never touches per-boid state.
+    Adding and removing boids edit the buffers in place with GL copies.
+    """
+
+    # language=GLSL
+    integrate_source = b"""
+    #version 330 core
+    layout(location = 0) in vec2 position;
+    layout(location = 1) in vec2 velocity;
+    layout(location = 2) in vec2 acceleration;
+
+    uniform float u_Delta;
+
+    out vec2 o_Position;
+    out vec2 o_Velocity;
+    out vec2 o_Previous;
+
+    void main() {
+        o_Previous = position;
+        o_Velocity = velocity + acceleration;
+        o_Position = position + o_Velocity * u_Delta;
+    }
+    """
+
+    # language=GLSL
+    steer_source = b"""
+    #version 330 core
+    layout(location = 0) in vec2 position;
+    layout(location = 1) in vec2 velocity;
+    layout(location = 2) in vec2 previous;
+
+    uniform samplerBuffer u_Positions;
+    uniform samplerBuffer u_Velocities;
+    uniform samplerBuffer u_Previous;
+
+    uniform int u_Count;
+    uniform float u_AlignRange;
+    uniform float u_SeparateRange;
+    uniform float u_MaxSpeed;
+    uniform float u_MaxForce;
+    uniform float u_Bound;
+
+    out vec2 o_Acceleration;
+    out vec3 o_Boid;
+
+    // Vec2.steer: set the magnitude to speed, subtract the velocity, limit to force.
+    vec2 steer(vec2 desired, float force) {
+        float magnitude = length(desired);
+        if (magnitude > 0.0) {
+            desired *= u_MaxSpeed / magnitude;
+        }
+
+        desired -= velocity;
+
+        float magnitude_2 = dot(desired, desired);
+        if (0.0 < force * force && force * force < magnitude_2) {
+            desired *= force / sqrt(magnitude_2);
+        }
+
+        return desired;
+    }
+
+    void main() {
+        float ar2 = u_AlignRange * u_AlignRange;
+        float sr2 = u_SeparateRange * u_SeparateRange;
+
+        vec2 velocity_sum = vec2(0.0);
+        vec2 center_sum = vec2(0.0);
+        vec2 away_sum = vec2(0.0);
+        int total = 0;
+        int separate_total = 0;
+
+        // ****** Neighbors ******
+        for (int j = 0; j < u_Count; ++j) {
+            if (j == gl_VertexID) {
+                continue;
+            }
+
+            vec2 delta = texelFetch(u_Previous, j).xy - previous;
+            float distance = dot(delta, delta);
+            if (distance >= ar2) {
+                continue;
+            }
+
+            vec2 other = texelFetch(u_Positions, j).xy;
+            velocity_sum += texelFetch(u_Velocities, j).xy;
+            center_sum += other;
+            total += 1;
+
+            if (distance < sr2) {
+                // Inverse square from the current positions, like Boid.flock.
+                vec2 away = position - other;
+                float d2 = dot(away, away);
+                if (d2 > 0.0) {
+                    away /= d2;
+                }
+
+                away_sum += away;
+                separate_total += 1;
+            }
+        }
+
+        // ****** Steering ******
+        vec2 acceleration = vec2(0.0);
+
+        // stay near the origin
+        if (dot(position, position) > u_Bound * u_Bound) {
+            acceleration += steer(-position, u_MaxForce) / 1.5;
+        }
+
+        acceleration += steer(velocity, u_MaxForce / 2.0);
+
+        if (total > 0) {
+            acceleration += steer(velocity_sum / float(total), u_MaxForce) / 4.0;
+            acceleration += steer(center_sum / float(total) - position, u_MaxForce) / 16.0;
+        }
+
+        if (separate_total > 0) {
+            acceleration += steer(away_sum / float(separate_total), u_MaxForce) / 2.0;
+        }
+
+        o_Acceleration = acceleration;
+
+        // ****** Update Drawable Shape ******
+        o_Boid = vec3(position, atan(velocity.y, velocity.x));
+    }
+    """
+
+    def __init__(
+            self, count: int, start: Vec2, bound_radius: float, timer: Optional[Timer] = None,
+            seed: Optional[int] = None
+    ):
+        self.bound = bound_radius
+        self.timer = timer
+        self.count = count
+
+        # The same boids as a Flock with the same seed.
+        self.seed, self.random = seeded(seed)
+        spawned = list(spawn(count, start, self.random))
+        positions = [(x, y) for x, y, _ in spawned]
+        velocities = [(velocity.x, velocity.y) for _, _, velocity in spawned]
+
+        positions = np.array(positions, dtype=np.float32).reshape(count, 2)
+        velocities = np.array(velocities, dtype=np.float32).reshape(count, 2)
+        zeros = np.zeros((count, 2), dtype=np.float32)
+
+        self.integrate_shader = Shader(
+            self.integrate_source, varyings=(b"o_Position", b"o_Velocity", b"o_Previous")
+        )
+        self.steer_shader = Shader(self.steer_source, varyings=(b"o_Acceleration", b"o_Boid"))
+
+        # ****** Buffers ******
+        # Positions and velocities ping-pong between two buffers each, `current` is the side last written.
+        self.current = 0
+        self.position_buffers = self.create_buffer(positions), self.create_buffer(positions)
+        self.velocity_buffers = self.create_buffer(velocities), self.create_buffer(velocities)
+        self.acceleration_buffer = self.create_buffer(zeros)
+        self.previous_buffer = self.create_buffer(zeros)
+
+        # Interleaved x, y, heading per boid, in the layout BoidRenderer draws.
+        self.render_buffer = self.create_buffer(np.zeros((count, 3), dtype=np.float32))
+
+        # Boids the buffers have room for.
+        self.capacity = count
+        self.create_views()
+
+        # ****** Uniforms ******
+        shader = self.steer_shader
+        with shader:
+            for unit, name in enumerate((b"u_Positions", b"u_Velocities", b"u_Previous")):
+                shader.set_uniform_1i(shader.get_uniform_location(name), unit)
+
+            self.count_location = shader.get_uniform_location(b"u_Count")
+            shader.set_uniform_1i(self.count_location, count)
+            for name, value in (
+                    (b"u_AlignRange", Boid.ALIGN_RANGE), (b"u_SeparateRange", Boid.SEPARATE_RANGE),
+                    (b"u_MaxSpeed", Boid.MAX_SPEED), (b"u_MaxForce", Boid.MAX_FORCE), (b"u_Bound", bound_radius),
+            ):
+                shader.set_uniform_1f(shader.get_uniform_location(name), value)
+
+        self.delta = self.integrate_shader.get_uniform_location(b"u_Delta")
+
+    @staticmethod
+    def create_buffer(data: np.ndarray) -> GLuint:
+        buffer = GLuint(0)
+        glGenBuffers(1, c.byref(buffer))
+        glBindBuffer(GL_ARRAY_BUFFER, buffer)
+        glBufferData(GL_ARRAY_BUFFER, max(1, data.nbytes), data.ctypes.data_as(c.c_void_p), GL_DYNAMIC_COPY)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+        return buffer
+
+    @staticmethod
+    def grow_buffer(buffer: GLuint, size: int, capacity: int) -> GLuint:
+        """A new buffer of `capacity` bytes starting with the first `size` bytes of `buffer`, which is deleted."""
+        grown = GLuint(0)
+        glGenBuffers(1, c.byref(grown))
+        glBindBuffer(GL_COPY_WRITE_BUFFER, grown)
+        glBufferData(GL_COPY_WRITE_BUFFER, capacity, None, GL_DYNAMIC_COPY)
+        if size:
+            glBindBuffer(GL_COPY_READ_BUFFER, buffer)
+            glCopyBufferSubData(GL_COPY_READ_BUFFER, GL_COPY_WRITE_BUFFER, 0, 0, size)
+            glBindBuffer(GL_COPY_READ_BUFFER, 0)
+
+        glBindBuffer(GL_COPY_WRITE_BUFFER, 0)
+        # GL holds on to the storage until the passes reading it are done.
+        glDeleteBuffers(1, c.byref(buffer))
+
+        return grown
+
+    @staticmethod
+    def create_texture(buffer: GLuint) -> GLuint:
+        texture = GLuint(0)
+        glGenTextures(1, c.byref(texture))
+        glBindTexture(GL_TEXTURE_BUFFER, texture)
+        glTexBuffer(GL_TEXTURE_BUFFER, GL_RG32F, buffer)
+        glBindTexture(GL_TEXTURE_BUFFER, 0)
+
+        return texture
+
+    @staticmethod
+    def create_vertex_array(*buffers: GLuint) -> GLuint:
+        """A vertex array reading one vec2 per boid from each buffer, at locations 0, 1, 2..."""
+        vertex_array = GLuint(0)
+        glGenVertexArrays(1, c.byref(vertex_array))
+        glBindVertexArray(vertex_array)
+
+        for location, buffer in enumerate(buffers):
+            glBindBuffer(GL_ARRAY_BUFFER, buffer)
+            glEnableVertexAttribArray(location)
+            glVertexAttribPointer(location, 2, GL_FLOAT, GL_FALSE, 2 * c.sizeof(GLfloat), None)
+
+        glBindVertexArray(0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+        return vertex_array
+
+    @staticmethod
+    def feedback(shader: Shader, vertex_array: GLuint, count: int, outputs: Tuple[GLuint, ...]):
+        """Run `shader` once per boid, capturing its varyings into `outputs`."""
+        for index, buffer in enumerate(outputs):
+            glBindBufferBase(GL_TRANSFORM_FEEDBACK_BUFFER, index, buffer)
+
+        with shader:
+            glBindVertexArray(vertex_array)
+            glBeginTransformFeedback(GL_POINTS)
+            glDrawArrays(GL_POINTS, 0, count)
+            glEndTransformFeedback()
+            glBindVertexArray(0)
+
+        for index in range(len(outputs)):
+            glBindBufferBase(GL_TRANSFORM_FEEDBACK_BUFFER, index, 0)
+
+    def create_views(self):
+        """The buffer textures and vertex arrays reading the buffers, made again whenever the buffers grow."""
+        # ****** Buffer Textures ******
+        self.position_textures = tuple(self.create_texture(buffer) for buffer in self.position_buffers)
+        self.velocity_textures = tuple(self.create_texture(buffer) for buffer in self.velocity_buffers)
+        self.previous_texture = self.create_texture(self.previous_buffer)
+
+        # ****** Vertex Arrays ******
+        # Integration reads one side; steering reads the side integration just wrote.
+        self.integrate_arrays = tuple(
+            self.create_vertex_array(self.position_buffers[side], self.velocity_buffers[side], self.acceleration_buffer)
+            for side in (0, 1)
+        )
+        self.steer_arrays = tuple(
+            self.create_vertex_array(self.position_buffers[side], self.velocity_buffers[side], self.previous_buffer)
+            for side in (0, 1)
+        )
+
+    def delete_views(self):
+        textures = (*self.position_textures, *self.velocity_textures, self.previous_texture)
+        glDeleteTextures(len(textures), (GLuint * len(textures))(*textures))
+
+        arrays = (*self.integrate_arrays, *self.steer_arrays)
+        glDeleteVertexArrays(len(arrays), (GLuint * len(arrays))(*arrays))
+
+    def per_boid_buffers(self) -> List[Tuple[GLuint, int]]:
+        """Every buffer the next tick reads, or that is drawn before it, with its floats per boid."""
+        current = self.current
+        return [
+            (self.position_buffers[current], 2), (self.velocity_buffers[current], 2),
+            (self.acceleration_buffer, 2), (self.previous_buffer, 2), (self.render_buffer, 3),
+        ]
+
+    def set_count(self, count: int):
+        self.count = count
+        self.steer_shader.set_uniform_1i(self.count_location, count)
+
+    def reserve(self, count: int):
+        """Make room for `count` boids, at least doubling the buffers so growing is amortized O(1)."""
+        if count <= self.capacity:
+            return
+
+        capacity = max(count, 2 * self.capacity)
+        float_size = c.sizeof(GLfloat)
+
+        def grow(buffer: GLuint, columns: int) -> GLuint:
+            return self.grow_buffer(buffer, self.count * columns * float_size, capacity * columns * float_size)
+
+        # Both sides, though only the current one is read: the other is written by the next tick.
+        self.position_buffers = tuple(grow(buffer, 2) for buffer in self.position_buffers)
+        self.velocity_buffers = tuple(grow(buffer, 2) for buffer in self.velocity_buffers)
+        self.acceleration_buffer = grow(self.acceleration_buffer, 2)
+        self.previous_buffer = grow(self.previous_buffer, 2)
+        self.render_buffer = grow(self.render_buffer, 3)
+        self.capacity = capacity
+
+        self.delete_views()
+        self.create_views()
+
+    def add(self, x: float, y: float) -> int:
+        """Add a boid at (x, y), flying in a random direction, and return its index."""
+        index = self.count
+        self.reserve(index + 1)
+
+        velocity = Vec2.from_random(Boid.MAX_SPEED, self.random)
+        rows = (x, y), (velocity.x, velocity.y), (0., 0.), (x, y), (x, y, velocity.angle)
+        for (buffer, columns), row in zip(self.per_boid_buffers(), rows):
+            data = (GLfloat * columns)(*row)
+            glBindBuffer(GL_ARRAY_BUFFER, buffer)
+            glBufferSubData(GL_ARRAY_BUFFER, index * c.sizeof(data), c.sizeof(data), data)
+
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        self.set_count(index + 1)
+
+        return index
+
+    def remove(self, index: int):
+        """Remove the boid at `index`, moving the last boid into its place."""
+        if not 0 <= index < self.count:
+            raise IndexError(f"Flock index {index} out of range for {self.count} boids")
+
+        last = self.count - 1
+        if index != last:
+            for buffer, columns in self.per_boid_buffers():
+                # Copying within one buffer is fine, as long as the ranges don't overlap.
+                size = columns * c.sizeof(GLfloat)
+                glBindBuffer(GL_COPY_READ_BUFFER, buffer)
+                glBindBuffer(GL_COPY_WRITE_BUFFER, buffer)
+                glCopyBufferSubData(GL_COPY_READ_BUFFER, GL_COPY_WRITE_BUFFER, last * size, index * size, size)
+
+            glBindBuffer(GL_COPY_READ_BUFFER, 0)
+            glBindBuffer(GL_COPY_WRITE_BUFFER, 0)
+
+        self.set_count(last)
+
+    def update(self, dt: float):
+        if not self.count:
+            return
+
+        source = self.current
+        target = 1 - source
+
+        start = perf_counter()
+        glEnable(GL_RASTERIZER_DISCARD)
+
+        with self.integrate_shader:
+            # Set under the same bind as the pass, and skipped while dt stays the same.
+            self.integrate_shader.set_uniform_1f(self.delta, dt)
+            self.feedback(
+                self.integrate_shader, self.integrate_arrays[source], self.count,
+                (self.position_buffers[target], self.velocity_buffers[target], self.previous_buffer)
+            )
+        integrated = perf_counter()
+
+        textures = self.position_textures[target], self.velocity_textures[target], self.previous_texture
+        for unit, texture in enumerate(textures):
+            glActiveTexture(GL_TEXTURE0 + unit)
+            glBindTexture(GL_TEXTURE_BUFFER, texture)
+
+        self.feedback(
+            self.steer_shader, self.steer_arrays[target], self.count,
+            (self.acceleration_buffer, self.render_buffer)
+        )
+
+        for unit in range(len(textures)):
+            glActiveTexture(GL_TEXTURE0 + unit)
+            glBindTexture(GL_TEXTURE_BUFFER, 0)
+        glActiveTexture(GL_TEXTURE0)
+
+        glDisable(GL_RASTERIZER_DISCARD)
+        self.current = target
+        steered = perf_counter()
+
+        # Only the time to submit each pass; the GPU finishes them later.
+        self.record(integration=integrated - start, steering=steered - integrated)
+
+    def read_buffer(self, buffer: GLuint, columns: int) -> np.ndarray:
+        data = np.empty((self.count, columns), dtype=np.float32)
+        glBindBuffer(GL_ARRAY_BUFFER, buffer)
+        glGetBufferSubData(GL_ARRAY_BUFFER, 0, data.nbytes, data.ctypes.data_as(c.c_void_p))
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+        return data
+
+    def read(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Copy the positions and velocities back to the CPU. Waits for the GPU, so only for checking results."""
+        current = self.current
+        return (
+            self.read_buffer(self.position_buffers[current], 2),
+            self.read_buffer(self.velocity_buffers[current], 2),
+        )
+
+    def frame(self) -> np.ndarray:
+        """Only read back while recording, since it waits for the GPU."""
+        return self.read_state()
+
+    def read_state(self) -> np.ndarray:
+        """Copy render_buffer back to the CPU, as a (count, 3) array like ArrayFlock.state."""
+        return self.read_buffer(self.render_buffer, 3)
+
+
+def create_context():
+    """A hidden window, for a current OpenGL context without anything on screen."""
+    import pyglet
+    return pyglet.window.Window(width=1, height=1, visible=False)
+
+
+def validate(count: int, ticks: int, dt: float = 1. / 30., seed: int = 0) -> List[float]:
+    """
+    Step a GPUFlock and an ArrayFlock from the same seed, and return the largest
+    position difference after every tick. Needs a current context.
+    """
+    from arrayflock import ArrayFlock
+
+    bound_radius = 360.
+    cpu = ArrayFlock(count, Vec2(0., 0.), bound_radius, seed=seed)
+    gpu = GPUFlock(count, Vec2(0., 0.), bound_radius, seed=seed)
+
+    errors = []
+    for _ in range(ticks):
+        cpu.update(dt)
+        gpu.update(dt)
+
+        positions, _ = gpu.read()
+        errors.append(float(np.abs(positions - cpu.positions).max()))
+
+    return errors
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Check the GPU flock against the CPU array engine")
+    parser.add_argument("--count", type=int, default=64)
+    parser.add_argument("--ticks", type=int, default=30)
+    parser.add_argument("--tolerance", type=float, default=1e-2, help="largest allowed position difference")
+    args = parser.parse_args()
+
+    window = create_context()
+    print(f"{str(c.cast(glGetString(GL_RENDERER), c.c_char_p).value, 'ascii')}")
+
+    differences = validate(args.count, args.ticks)
+    worst = max(differences, default=0.)
+    print(f"{args.count} boids, {args.ticks} ticks: largest position difference {worst:.3g}")
+
+    window.close()
+    if worst > args.tolerance:
+        raise SystemExit(f"The GPU flock differs from the CPU flock by more than {args.tolerance}")
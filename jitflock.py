@@ -0,0 +1,221 @@
+from math import atan2, sqrt
+from time import perf_counter
+
+import numpy as np
+
+from arrayflock import ArrayFlock
+from boid import Boid
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+    prange = range
+
+# Whether the kernels below are compiled. Without numba they still run, as plain (slow) Python.
+JIT_AVAILABLE = njit is not None
+
+
+def jit(parallel: bool = False):
+    if njit is None:
+        return lambda function: function
+
+    return njit(parallel=parallel, cache=True)
+
+
+@jit()
+def steer(x: float, y: float, vx: float, vy: float, speed: float, force: float):
+    """Vec2.steer on plain floats: set magnitude to speed, subtract (vx, vy), limit to force."""
+    mag = sqrt(x * x + y * y)
+    if mag > 0.:
+        ratio = speed / mag
+        x *= ratio
+        y *= ratio
+
+    x -= vx
+    y -= vy
+
+    mag_2 = x * x + y * y
+    if 0. < force * force < mag_2:
+        ratio = force / sqrt(mag_2)
+        x *= ratio
+        y *= ratio
+
+    return x, y
+
+
+@jit(parallel=True)
+def integrate(positions, velocities, accelerations, previous, dt: float):
+    for i in prange(positions.shape[0]):
+        previous[i, 0] = positions[i, 0]
+        previous[i, 1] = positions[i, 1]
+
+        velocities[i, 0] += accelerations[i, 0]
+        velocities[i, 1] += accelerations[i, 1]
+        positions[i, 0] += velocities[i, 0] * dt
+        positions[i, 1] += velocities[i, 1] * dt
+
+
+@jit()
+def bin_boids(previous, inverse: float):
+    """
+    Counting sort of the boids into a uniform grid of 1 / inverse sized cells.
+
+    Returns the boid indices ordered by cell, the offset of every cell's first
+    entry in that order (plus a final end offset), the grid origin and its size.
+    """
+    count = previous.shape[0]
+    min_x = previous[:, 0].min()
+    min_y = previous[:, 1].min()
+    width = int((previous[:, 0].max() - min_x) * inverse) + 1
+    height = int((previous[:, 1].max() - min_y) * inverse) + 1
+
+    cells = np.empty(count, np.int64)
+    starts = np.zeros(width * height + 1, np.int64)
+    for i in range(count):
+        cell = int((previous[i, 1] - min_y) * inverse) * width + int((previous[i, 0] - min_x) * inverse)
+        cells[i] = cell
+        starts[cell + 1] += 1
+
+    for cell in range(width * height):
+        starts[cell + 1] += starts[cell]
+
+    fill = starts[:-1].copy()
+    order = np.empty(count, np.int64)
+    for i in range(count):
+        cell = cells[i]
+        order[fill[cell]] = i
+        fill[cell] += 1
+
+    return order, starts, min_x, min_y, width, height
+
+
+@jit(parallel=True)
+def flock(
+        previous, positions, velocities, accelerations, state,
+        order, starts, min_x: float, min_y: float, width: int, height: int, inverse: float,
+        align_range: float, separate_range: float, max_speed: float, max_force: float, bound: float
+):
+    """
+    Set every boid's acceleration from the bound, speed and flocking rules and write its
+    render state. Each boid only reads the 3x3 block of cells around it, so the cells
+    must be at least align_range across.
+    """
+    ar2 = align_range * align_range
+    sr2 = separate_range * separate_range
+
+    for i in prange(positions.shape[0]):
+        x0 = previous[i, 0]
+        y0 = previous[i, 1]
+        cell_x = int((x0 - min_x) * inverse)
+        cell_y = int((y0 - min_y) * inverse)
+
+        px = positions[i, 0]
+        py = positions[i, 1]
+        vx = velocities[i, 0]
+        vy = velocities[i, 1]
+
+        velocity_x = velocity_y = 0.
+        center_x = center_y = 0.
+        away_x = away_y = 0.
+        total = 0
+        separate_total = 0
+
+        # ****** Neighbors ******
+        for gy in range(max(cell_y - 1, 0), min(cell_y + 2, height)):
+            for gx in range(max(cell_x - 1, 0), min(cell_x + 2, width)):
+                cell = gy * width + gx
+                for k in range(starts[cell], starts[cell + 1]):
+                    j = order[k]
+                    if j == i:
+                        continue
+
+                    dx = previous[j, 0] - x0
+                    dy = previous[j, 1] - y0
+                    distance = dx * dx + dy * dy
+                    if distance >= ar2:
+                        continue
+
+                    velocity_x += velocities[j, 0]
+                    velocity_y += velocities[j, 1]
+                    center_x += positions[j, 0]
+                    center_y += positions[j, 1]
+                    total += 1
+
+                    if distance < sr2:
+                        # Inverse square from the current positions, like Boid.flock.
+                        ox = px - positions[j, 0]
+                        oy = py - positions[j, 1]
+                        d2 = ox * ox + oy * oy
+                        if d2 > 0.:
+                            ox /= d2
+                            oy /= d2
+
+                        away_x += ox
+                        away_y += oy
+                        separate_total += 1
+
+        # ****** Steering ******
+        ax = ay = 0.
+
+        # stay near the origin
+        if px * px + py * py > bound * bound:
+            sx, sy = steer(-px, -py, vx, vy, max_speed, max_force)
+            ax += sx / 1.5
+            ay += sy / 1.5
+
+        sx, sy = steer(vx, vy, vx, vy, max_speed, max_force / 2)
+        ax += sx
+        ay += sy
+
+        if total:
+            sx, sy = steer(velocity_x / total, velocity_y / total, vx, vy, max_speed, max_force)
+            ax += sx / 4.
+            ay += sy / 4.
+
+            sx, sy = steer(center_x / total - px, center_y / total - py, vx, vy, max_speed, max_force)
+            ax += sx / 16.
+            ay += sy / 16.
+
+        if separate_total:
+            sx, sy = steer(away_x / separate_total, away_y / separate_total, vx, vy, max_speed, max_force)
+            ax += sx / 2.
+            ay += sy / 2.
+
+        accelerations[i, 0] = ax
+        accelerations[i, 1] = ay
+
+        # ****** Update Drawable Shape ******
+        state[i, 0] = px
+        state[i, 1] = py
+        state[i, 2] = atan2(vy, vx)
+
+
+class JitFlock(ArrayFlock):
+    """
+    ArrayFlock stepped by numba-compiled kernels.
+
+    Neighbors come from a uniform grid of ALIGN_RANGE cells rebuilt with a counting
+    sort every tick, so a tick costs O(n) rather than ArrayFlock's O(n^2), and the
+    per-boid loop runs in parallel across every core.
+    """
+
+    def update(self, dt: float):
+        if not self.count:
+            return
+
+        start = perf_counter()
+        integrate(self.positions, self.velocities, self.accelerations, self.previous, dt)
+        integrated = perf_counter()
+
+        inverse = 1. / Boid.ALIGN_RANGE
+        order, starts, min_x, min_y, width, height = bin_boids(self.previous, inverse)
+        flock(
+            self.previous, self.positions, self.velocities, self.accelerations, self.state,
+            order, starts, min_x, min_y, width, height, inverse,
+            Boid.ALIGN_RANGE, Boid.SEPARATE_RANGE, Boid.MAX_SPEED, Boid.MAX_FORCE, self.bound
+        )
+        steered = perf_counter()
+
+        # The render state is written by the flock kernel, so there is no state phase.
+        self.record(integration=integrated - start, steering=steered - integrated)
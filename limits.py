@@ -0,0 +1,4 @@
+"""Limits shared by the simulation and the renderer, in a module neither has to pull the other in for."""
+
+# Most species in a Scene, and colours BoidRenderer holds: one per value of a species byte.
+MAX_SPECIES = 256
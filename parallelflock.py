@@ -0,0 +1,181 @@
+import multiprocessing as mp
+import os
+import weakref
+from multiprocessing.shared_memory import SharedMemory
+from multiprocessing.synchronize import Barrier, Event
+from time import perf_counter
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from arrayflock import ArrayFlock, Grid, flock_range
+from boid import Boid
+from timer import Timer
+from vectors import Vec2
+
+# Arrays kept in the shared block, in order. Each is (count, 2).
+SHARED_ARRAYS = "positions", "velocities", "accelerations", "previous"
+
+# Then the grid: its order and keys, one int64 per boid each, and its frame.
+FRAME = 4
+
+
+def shared_size(count: int, dtype) -> int:
+    return len(SHARED_ARRAYS) * count * 2 * np.dtype(dtype).itemsize + (2 * count + FRAME) * 8
+
+
+def shared_views(memory: SharedMemory, count: int, dtype) -> Tuple[List[np.ndarray], Grid]:
+    """The per-boid arrays in the shared block, and the grid over them."""
+    size = count * 2 * np.dtype(dtype).itemsize
+    arrays = [
+        np.ndarray((count, 2), dtype=dtype, buffer=memory.buf, offset=i * size)
+        for i in range(len(SHARED_ARRAYS))
+    ]
+
+    offset = len(SHARED_ARRAYS) * size
+    order, keys, frame = (
+        np.ndarray((length,), dtype=np.int64, buffer=memory.buf, offset=offset + start * 8)
+        for start, length in ((0, count), (count, count), (2 * count, FRAME))
+    )
+
+    return arrays, Grid(Boid.ALIGN_RANGE / 2, 2, order, keys, frame)
+
+
+def _worker(
+        name: str, capacity: int, dtype, block: int,
+        worker: int, workers: int, barrier: Barrier, stopping: Event
+):
+    memory = SharedMemory(name)
+    (positions, velocities, accelerations, previous), grid = shared_views(memory, capacity, dtype)
+
+    try:
+        while True:
+            # Wait for the main process to finish integrating and binning this tick.
+            barrier.wait()
+            if stopping.is_set():
+                break
+
+            # This worker's share of the boids in cell order, so it only reads boids near them.
+            count = int(grid.frame[0])
+            begin = worker * count // workers
+            end = (worker + 1) * count // workers
+            flock_range(
+                previous[:count], positions[:count], velocities[:count], accelerations,
+                grid.order[begin:end], grid, block
+            )
+
+            # Tell the main process this range's accelerations are written.
+            barrier.wait()
+    finally:
+        del positions, velocities, accelerations, previous, grid
+        memory.close()
+
+
+def _shutdown(processes: List[mp.Process], barrier: Barrier, stopping: Event, memory: SharedMemory):
+    stopping.set()
+    try:
+        barrier.wait(timeout=5.)
+    except Exception:
+        pass
+
+    for process in processes:
+        process.join(timeout=5.)
+        if process.is_alive():
+            process.terminate()
+
+    memory.close()
+    memory.unlink()
+
+
+class ParallelFlock(ArrayFlock):
+    """
+    ArrayFlock whose flocking forces are computed by a pool of worker processes.
+
+    The per-boid arrays and the grid live in one shared memory block. Every tick
+    the main process integrates and sorts the boids into the grid, then each
+    worker adds the flocking forces for its own run of boids in cell order, with
+    a barrier on either side of that phase. A run in cell order is a patch of
+    neighboring cells, so each worker only reads the boids in and around it.
+
+    Workers are started with forkserver or spawn, so a script creating one needs
+    an `if __name__ == '__main__':` guard.
+    """
+
+    def __init__(
+            self, count: int, start: Vec2, bound_radius: float,
+            workers: Optional[int] = None, dtype=np.float64, timer: Optional[Timer] = None,
+            seed: Optional[int] = None
+    ):
+        super().__init__(count, start, bound_radius, dtype, timer, seed)
+
+        # Most workers to run, fewer while there are fewer boids.
+        self.max_workers = (os.cpu_count() or 1) if workers is None else workers
+        self._start()
+
+    def _start(self):
+        """Move the per-boid arrays into a new shared block, as large as the storage, and start a pool on it."""
+        capacity = len(self.boid_data) // 3
+        dtype = self.dtype
+        self.workers = max(1, min(self.max_workers, capacity))
+
+        self.memory = SharedMemory(create=True, size=max(1, shared_size(capacity, dtype)))
+        views, self.grid = shared_views(self.memory, capacity, dtype)
+        for name, view in zip(SHARED_ARRAYS, views):
+            view[:] = self.storage[name]
+            self.storage[name] = view
+
+        self.view()
+
+        # Never fork: reserve restarts the pool mid-run, when the recorder's, pyglet's or numba's
+        # threads may be holding locks a forked child would inherit locked.
+        context = mp.get_context("forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn")
+        self.barrier = context.Barrier(self.workers + 1)
+        self.stopping = context.Event()
+        self.processes = []
+        for worker in range(self.workers):
+            process = context.Process(
+                target=_worker, daemon=True,
+                args=(
+                    self.memory.name, capacity, dtype, self.BLOCK_PAIRS,
+                    worker, self.workers, self.barrier, self.stopping
+                )
+            )
+            process.start()
+            self.processes.append(process)
+
+        self._finalizer = weakref.finalize(
+            self, _shutdown, self.processes, self.barrier, self.stopping, self.memory
+        )
+
+    def reserve(self, count: int):
+        """
+        Make room for `count` boids. The workers are bound to the shared block, so
+        growing it restarts them, which the doubling in ArrayFlock.reserve keeps rare.
+        """
+        if count <= len(self.boid_data) // 3:
+            return
+
+        # Copies every boid out of the shared block, into larger private arrays.
+        super().reserve(count)
+
+        self.grid = None
+        self._finalizer()
+        self._start()
+
+    def update(self, dt: float):
+        start = perf_counter()
+        self.integrate(dt)
+        # Sorted once here, into shared memory, for every worker.
+        self.grid.rebuild(self.previous)
+        integrated = perf_counter()
+
+        # Release the workers, then wait for all of them to finish this tick.
+        self.barrier.wait()
+        self.barrier.wait()
+        steered = perf_counter()
+
+        self.write_state()
+        self.record(integration=integrated - start, steering=steered - integrated, state=perf_counter() - steered)
+
+    def close(self):
+        self._finalizer()
@@ -0,0 +1,205 @@
+from math import isfinite
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
+
+Point = Tuple[float, float, Any]
+
+
+class Quad:
+    CAPACITY = 8
+    MAX_DEPTH = 16
+
+    __slots__ = "x", "y", "half", "depth", "points", "children"
+
+    x: float
+    y: float
+    half: float
+    depth: int
+    points: List[Point]
+    children: Optional[Tuple["Quad", "Quad", "Quad", "Quad"]]
+
+    def __init__(self, x: float, y: float, half: float, depth: int = 0):
+        self.x = x
+        self.y = y
+        self.half = half
+        self.depth = depth
+        self.points = []
+        self.children = None
+
+    def insert(self, x: float, y: float, item: Any):
+        node = self
+        while node.children is not None:
+            node = node.child_for(x, y)
+
+        node.points.append((x, y, item))
+        if len(node.points) > node.CAPACITY and node.depth < node.MAX_DEPTH:
+            node.subdivide()
+
+    def children_index(self, x: float, y: float) -> int:
+        # Children are ordered SW, SE, NW, NE.
+        return (x >= self.x) + 2 * (y >= self.y)
+
+    def child_for(self, x: float, y: float) -> "Quad":
+        return self.children[self.children_index(x, y)]
+
+    def leaves_near(self, x: float, y: float, reach: float) -> Iterator["Quad"]:
+        """Leaves whose squares come within `reach` of (x, y) along both axes."""
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if abs(node.x - x) > node.half + reach or abs(node.y - y) > node.half + reach:
+                continue
+
+            if node.children is None:
+                yield node
+            else:
+                stack.extend(node.children)
+
+    def leaves(self) -> Iterator["Quad"]:
+        return self.leaves_near(self.x, self.y, self.half)
+
+    def subdivide(self):
+        half = self.half / 2
+        depth = self.depth + 1
+        x, y = self.x, self.y
+        self.children = (
+            Quad(x - half, y - half, half, depth),
+            Quad(x + half, y - half, half, depth),
+            Quad(x - half, y + half, half, depth),
+            Quad(x + half, y + half, half, depth),
+        )
+
+        points = self.points
+        self.points = []
+        for px, py, item in points:
+            self.child_for(px, py).insert(px, py, item)
+
+
+class QuadTree:
+    """Point quad-tree rebuilt from scratch every frame."""
+
+    __slots__ = "root",
+
+    root: Quad
+
+    def __init__(self, x: float = 0., y: float = 0., half: float = 1.):
+        self.root = Quad(x, y, half)
+
+    def clear(self, x: float = 0., y: float = 0., half: float = 1.):
+        self.root = Quad(x, y, half)
+
+    def insert(self, x: float, y: float, item: Any):
+        """Add one point, growing the root until it covers (x, y)."""
+        if not (isfinite(x) and isfinite(y)):
+            raise ValueError(f"Can't insert a point at ({x}, {y})")
+
+        root = self.root
+        while abs(x - root.x) > root.half or abs(y - root.y) > root.half:
+            root = self.grow(x, y)
+
+        root.insert(x, y, item)
+
+    def grow(self, x: float, y: float) -> Quad:
+        """Double the root towards (x, y), the old root becoming one of the new root's children."""
+        old = self.root
+        half = old.half
+        # Depths only cap subdivision, so the new root sits one level above the old one.
+        depth = old.depth - 1
+        root = Quad(old.x + (half if x >= old.x else -half), old.y + (half if y >= old.y else -half), 2 * half, depth)
+
+        children = [
+            Quad(root.x + dx * half, root.y + dy * half, half, old.depth)
+            for dy in (-1, 1) for dx in (-1, 1)
+        ]
+        children[root.children_index(old.x, old.y)] = old
+        root.children = tuple(children)
+
+        self.root = root
+        return root
+
+    def rebuild(self, points: Iterable[Point]):
+        points = list(points)
+        if not points:
+            self.clear()
+            return
+
+        min_x = max_x = points[0][0]
+        min_y = max_y = points[0][1]
+        for x, y, _ in points:
+            if x < min_x:
+                min_x = x
+            elif x > max_x:
+                max_x = x
+
+            if y < min_y:
+                min_y = y
+            elif y > max_y:
+                max_y = y
+
+        # Pad the root so points on the far edges still land inside it.
+        half = max(max_x - min_x, max_y - min_y, 1.) / 2 + 1.
+        self.clear((min_x + max_x) / 2, (min_y + max_y) / 2, half)
+
+        root = self.root
+        for x, y, item in points:
+            root.insert(x, y, item)
+
+    def query(self, x: float, y: float, radius: float) -> List[Tuple[Any, float]]:
+        """Return (item, squared distance) for every point strictly within radius of (x, y)."""
+        found = []
+        r2 = radius * radius
+
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+
+            # Skip nodes whose square cannot intersect the query circle.
+            reach = node.half + radius
+            if abs(node.x - x) > reach or abs(node.y - y) > reach:
+                continue
+
+            if node.children is not None:
+                stack.extend(node.children)
+                continue
+
+            for px, py, item in node.points:
+                dx = px - x
+                dy = py - y
+                d2 = dx * dx + dy * dy
+                if d2 < r2:
+                    found.append((item, d2))
+
+        return found
+
+    def pairs(self, radius: float) -> Iterator[Tuple[Any, Any, float]]:
+        """Yield (item, item, squared distance) once for every unordered pair strictly within radius."""
+        r2 = radius * radius
+
+        leaves = [leaf for leaf in self.root.leaves() if leaf.points]
+        order = {id(leaf): i for i, leaf in enumerate(leaves)}
+
+        for i, leaf in enumerate(leaves):
+            points = leaf.points
+
+            # Pairs inside this leaf.
+            for a in range(len(points)):
+                ax, ay, item = points[a]
+                for b in range(a + 1, len(points)):
+                    bx, by, other = points[b]
+                    dx = bx - ax
+                    dy = by - ay
+                    d2 = dx * dx + dy * dy
+                    if d2 < r2:
+                        yield item, other, d2
+
+            # Pairs with leaves later in the order, so each pair of leaves is only visited once.
+            for near in self.root.leaves_near(leaf.x, leaf.y, leaf.half + radius):
+                if order.get(id(near), -1) <= i:
+                    continue
+
+                for ax, ay, item in points:
+                    for bx, by, other in near.points:
+                        dx = bx - ax
+                        dy = by - ay
+                        d2 = dx * dx + dy * dy
+                        if d2 < r2:
+                            yield item, other, d2
@@ -0,0 +1,359 @@
+"""
+Boid trajectories on disk: x, y, heading for every boid, every tick.
+
+A trajectory is:
+
+    HEADER                          magic, version
+    chunks, each:
+        CHUNK                       frames, flags, raw size, stored size
+        one uint32 count per frame
+        the frames' float32 x, y, heading triples, as stored by the flags
+    index                           INDEX entry per chunk, written on close
+    TRAILER                         index offset, chunks, end magic
+
+The structs are little-endian, counts and frames are in native byte order.
+Frames are in the layout BoidRenderer uploads. Uncompressed chunks can be
+read straight out of a memory map without copying. A file cut short by a
+crash has no index, and the reader falls back to walking the chunks.
+
+TrajectoryWriter queues frames for its writer thread, at most two chunks'
+worth. When compression or the disk falls behind for longer than that, write
+blocks until there is room, so memory stays bounded and no frame is lost.
+Each such wait is counted in TrajectoryWriter.stalls.
+"""
+import mmap
+import struct
+import zlib
+from array import array
+from ctypes import Array, c_float, sizeof
+from queue import Full, Queue
+from threading import Thread
+from typing import Iterator, List, Optional, Tuple, Union
+
+from timer import Timer
+
+MAGIC = b"FLOXTRAJ"
+END = b"FLOXEND\0"
+VERSION = 1
+
+HEADER = struct.Struct("<8sI")
+CHUNK = struct.Struct("<IBQQ")
+INDEX = struct.Struct("<QQ")
+TRAILER = struct.Struct("<QQ8s")
+
+# Bytes per boid in a frame.
+STRIDE = 3 * sizeof(c_float)
+
+# Chunk flags. A shuffled chunk stores the first byte of every float, then every
+# second byte and so on, which puts the slowly changing sign and exponent bytes
+# side by side and lets zlib shrink chunks by another sixth or so.
+COMPRESSED = 1
+SHUFFLED = 2
+
+
+def shuffle(data: bytes) -> bytes:
+    return b"".join(data[i::4] for i in range(4))
+
+
+def unshuffle(data: bytes) -> bytearray:
+    plane = len(data) // 4
+    out = bytearray(len(data))
+    for i in range(4):
+        out[i::4] = data[i * plane:(i + 1) * plane]
+
+    return out
+
+
+class TrajectoryWriter:
+    """
+    Streams frames to a trajectory file from a background thread.
+
+    write only copies the frame and queues it. Compression and disk writes happen
+    on the writer thread, so a slow disk only holds up the simulation loop once
+    the queue is full.
+    """
+
+    def __init__(self, path: str, chunk_frames: int = 64, level: int = 1, max_queued: Optional[int] = None):
+        """
+        `level` is the zlib level, 0 stores the frames uncompressed. `max_queued` is
+        the most frames waiting for the writer thread, two chunks by default.
+        """
+        self.path = path
+        self.chunk_frames = chunk_frames
+        self.level = level
+        self.frames = 0
+
+        # Writes that had to wait for the writer thread to make room.
+        self.stalls = 0
+
+        self._queue: Queue = Queue(2 * chunk_frames if max_queued is None else max_queued)
+        self._error: Optional[BaseException] = None
+        self._file = open(path, "wb")
+        self._file.write(HEADER.pack(MAGIC, VERSION))
+
+        self._thread = Thread(target=self._run, name="trajectory writer", daemon=True)
+        self._thread.start()
+
+    def write(self, boid_data: Union[Array, memoryview], count: int):
+        """Queue the first `count` boids of `boid_data`, or anything else exposing float32 triples, as the next frame."""
+        if self._error is not None:
+            raise self._error
+
+        item = count, bytes(memoryview(boid_data).cast("B")[:count * STRIDE])
+        try:
+            self._queue.put_nowait(item)
+        except Full:
+            self.stalls += 1
+            self._queue.put(item)
+
+        self.frames += 1
+
+    def close(self):
+        if self._file.closed:
+            return
+
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self) -> "TrajectoryWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    # ****** Writer Thread ******
+
+    def _run(self):
+        index: List[Tuple[int, int]] = []
+        counts = array("I")
+        frames: List[bytes] = []
+        written = 0
+        item = ()
+
+        try:
+            while True:
+                item = self._queue.get()
+                if item is not None:
+                    count, frame = item
+                    counts.append(count)
+                    frames.append(frame)
+
+                if frames and (item is None or len(frames) >= self.chunk_frames):
+                    index.append((self._file.tell(), written))
+                    self._write_chunk(counts, frames)
+                    written += len(frames)
+                    counts = array("I")
+                    frames = []
+
+                if item is None:
+                    break
+
+            offset = self._file.tell()
+            for entry in index:
+                self._file.write(INDEX.pack(*entry))
+
+            self._file.write(TRAILER.pack(offset, len(index), END))
+            self._file.flush()
+        except BaseException as error:
+            self._error = error
+
+            # Keep emptying the queue until close, so write and close never wait on a dead thread.
+            while item is not None:
+                item = self._queue.get()
+
+    def _write_chunk(self, counts: array, frames: List[bytes]):
+        raw = b"".join(frames)
+        if self.level > 0:
+            flags = COMPRESSED | SHUFFLED
+            stored = zlib.compress(shuffle(raw), self.level)
+        else:
+            flags = 0
+            stored = raw
+
+        file = self._file
+        file.write(CHUNK.pack(len(frames), flags, len(raw), len(stored)))
+        file.write(counts.tobytes())
+        file.write(stored)
+
+
+class Chunk:
+    __slots__ = "offset", "first", "frames", "flags", "raw_size", "counts", "data"
+
+    def __init__(self, mapped: mmap.mmap, offset: int, first: int):
+        frames, flags, raw_size, stored_size = CHUNK.unpack_from(mapped, offset)
+        self.offset = offset
+        self.first = first
+        self.frames = frames
+        self.flags = flags
+        self.raw_size = raw_size
+
+        start = offset + CHUNK.size
+        self.counts = array("I")
+        self.counts.frombytes(mapped[start:start + 4 * frames])
+
+        start += 4 * frames
+        self.data = start, start + stored_size
+
+    @property
+    def end(self) -> int:
+        return self.data[1]
+
+
+class TrajectoryReader:
+    """
+    Memory-maps a trajectory and reads its frames lazily. Only the chunk holding
+    the frame asked for is decompressed, and only the latest one is kept.
+    """
+
+    def __init__(self, path: str):
+        self._file = open(path, "rb")
+        # Copy on write rather than read only, so frames of uncompressed chunks can back
+        # ctypes arrays without a copy. Nothing writes to them, so nothing is copied.
+        self._mapped = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_COPY)
+        self._view = memoryview(self._mapped)
+
+        magic, version = HEADER.unpack_from(self._mapped, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a trajectory")
+        if version != VERSION:
+            raise ValueError(f"Unsupported trajectory version {version}, expected {VERSION}")
+
+        self.chunks = self._read_index() or self._walk_chunks()
+        self.frames = sum(chunk.frames for chunk in self.chunks)
+
+        self._cached: Optional[Chunk] = None
+        self._cached_data: Optional[memoryview] = None
+        self._cached_offsets: List[int] = []
+
+    def _read_index(self) -> List[Chunk]:
+        mapped = self._mapped
+        if len(mapped) < HEADER.size + TRAILER.size:
+            return []
+
+        offset, count, end = TRAILER.unpack_from(mapped, len(mapped) - TRAILER.size)
+        if end != END:
+            return []
+
+        return [
+            Chunk(mapped, *INDEX.unpack_from(mapped, offset + i * INDEX.size))
+            for i in range(count)
+        ]
+
+    def _walk_chunks(self) -> List[Chunk]:
+        """Find the chunks of a file with no index, stopping at the first one cut short."""
+        mapped = self._mapped
+        chunks = []
+        offset = HEADER.size
+        first = 0
+        while offset + CHUNK.size <= len(mapped):
+            try:
+                chunk = Chunk(mapped, offset, first)
+            except ValueError:
+                # The counts themselves were cut short.
+                break
+
+            if chunk.end > len(mapped):
+                break
+
+            chunks.append(chunk)
+            offset = chunk.end
+            first += chunk.frames
+
+        return chunks
+
+    def __len__(self) -> int:
+        return self.frames
+
+    def _load(self, chunk: Chunk):
+        if self._cached is chunk:
+            return
+
+        start, end = chunk.data
+        if chunk.flags & COMPRESSED:
+            data = zlib.decompress(self._view[start:end])
+            if chunk.flags & SHUFFLED:
+                data = unshuffle(data)
+
+            data = memoryview(data)
+        else:
+            # Straight out of the map, no copy.
+            data = self._view[start:end]
+
+        offsets = [0]
+        for count in chunk.counts:
+            offsets.append(offsets[-1] + count * STRIDE)
+
+        self._cached = chunk
+        self._cached_data = data
+        self._cached_offsets = offsets
+
+    def frame(self, index: int) -> memoryview:
+        """x, y, heading float32s of every boid in frame `index`."""
+        if not 0 <= index < self.frames:
+            raise IndexError(f"Frame {index} out of range for {self.frames} frames")
+
+        # Chunks are ordered by their first frame.
+        low, high = 0, len(self.chunks) - 1
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.chunks[middle].first <= index:
+                low = middle
+            else:
+                high = middle - 1
+
+        chunk = self.chunks[low]
+        self._load(chunk)
+
+        i = index - chunk.first
+        offsets = self._cached_offsets
+        return self._cached_data[offsets[i]:offsets[i + 1]].cast("f")
+
+    def __iter__(self) -> Iterator[memoryview]:
+        return self.iterate()
+
+    def iterate(self, start: int = 0, step: int = 1) -> Iterator[memoryview]:
+        """Yield frames lazily, from `start`, every `step`th one."""
+        for index in range(start, self.frames, step):
+            yield self.frame(index)
+
+    def close(self):
+        # Views of an uncompressed chunk point into the map and have to go first.
+        self._cached = self._cached_data = None
+        self._view.release()
+        self._mapped.close()
+        self._file.close()
+
+    def __enter__(self) -> "TrajectoryReader":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class Recorded:
+    """
+    Base of everything stepped like a flock. Each tick ends with record, which
+    hands the tick's render state to `recorder` and its phase times to `timer`,
+    whichever are set.
+    """
+
+    recorder: Optional[TrajectoryWriter] = None
+    timer: Optional[Timer] = None
+
+    def frame(self) -> Union[Array, memoryview]:
+        """This tick's x, y, heading per boid, as BoidRenderer uploads them."""
+        return self.boid_data
+
+    def record(self, **phases: float):
+        """Finish a tick. `phases` are the seconds each named part of it took."""
+        if self.recorder is not None:
+            self.recorder.write(self.frame(), self.count)
+
+        timer = self.timer
+        if timer is not None:
+            for name, dt in phases.items():
+                timer.record(name, dt)
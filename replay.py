@@ -0,0 +1,64 @@
+from ctypes import Array, c_float
+from typing import Optional
+
+from recorder import TrajectoryReader
+
+
+def as_floats(frame: memoryview) -> Array:
+    """A ctypes float array over a frame, without copying it when the frame's memory allows."""
+    floats = c_float * len(frame)
+    try:
+        return floats.from_buffer(frame)
+    except TypeError:
+        # Read-only memory, such as a decompressed chunk.
+        return floats.from_buffer_copy(frame)
+
+
+class Replay:
+    """
+    Stands in for a flock, stepping through a recorded trajectory instead of
+    simulating. Every update moves `speed` frames along the recording and
+    exposes that frame as boid_data, ready for BoidRenderer.update.
+    """
+
+    def __init__(self, path: str, speed: float = 1.):
+        self.reader = TrajectoryReader(path)
+        self.speed = speed
+        self.paused = False
+
+        # Playhead, in frames. Fractional so slow speeds still advance.
+        self.position = 0.
+        self.frame: Optional[int] = None
+
+        # A recording without a complete chunk plays back as no boids.
+        self.count = 0
+        self.boid_data: Optional[Array] = (c_float * 0)()
+        self.load(0)
+
+    @property
+    def frames(self) -> int:
+        return len(self.reader)
+
+    def seek(self, frame: float):
+        """Move the playhead to `frame`, clamped to the recording."""
+        self.position = min(max(frame, 0.), max(self.frames - 1, 0))
+        self.load(int(self.position))
+
+    def update(self, dt: float):
+        if not self.paused:
+            self.seek(self.position + self.speed)
+
+    def load(self, frame: int):
+        if frame == self.frame or not self.frames:
+            return
+
+        # Drop the old frame first, it may be a view into the reader's cached chunk.
+        self.boid_data = None
+        data = self.reader.frame(frame)
+        self.boid_data = as_floats(data)
+        self.count = len(data) // 3
+        self.frame = frame
+
+    def close(self):
+        self.boid_data = None
+        self.reader.close()
@@ -0,0 +1,222 @@
+from ctypes import addressof, c_float, c_ubyte, memmove, memset, sizeof
+from math import cos, sin, tau
+from time import perf_counter
+from typing import List, Optional, Sequence, Tuple, Type
+
+from boid import Boid, Flock, seeded
+from limits import MAX_SPECIES
+from quadtree import QuadTree
+from recorder import Recorded
+from spatialhash import SpatialHash
+from timer import Timer
+from vectors import Vec2
+
+Color = Tuple[float, float, float]
+
+# Bytes per boid in boid_data: x, y, heading.
+STRIDE = 3 * sizeof(c_float)
+
+
+class Species:
+    """
+    One flock of a Scene: its size, its colour and the parameters of its boids.
+
+    The parameters become the class constants of a Boid subclass made for the
+    species, so every Boid and Flock method picks them up unchanged, and a
+    boid's class tells which species it is.
+    """
+
+    __slots__ = "name", "count", "color", "avoid_range", "boid_type"
+
+    name: str
+    count: int
+    color: Color
+
+    # How far the boids keep away from every other species. 0 ignores them.
+    avoid_range: float
+
+    boid_type: Type[Boid]
+
+    def __init__(
+            self, name: str, count: int, color: Color,
+            max_force: float = Boid.MAX_FORCE, max_speed: float = Boid.MAX_SPEED,
+            align_range: float = Boid.ALIGN_RANGE, separate_range: float = Boid.SEPARATE_RANGE,
+            avoid_range: float = 0.
+    ):
+        self.name = name
+        self.count = count
+        self.color = color
+        self.avoid_range = avoid_range
+        self.boid_type = type(f"{name.title()}Boid", (Boid,), {
+            "__slots__": (),
+            "MAX_FORCE": max_force,
+            "MAX_SPEED": max_speed,
+            "ALIGN_RANGE": align_range,
+            "SEPARATE_RANGE": separate_range,
+        })
+
+    @property
+    def reach(self) -> float:
+        """Furthest a boid of this species looks for other boids."""
+        return max(self.boid_type.ALIGN_RANGE, self.avoid_range)
+
+
+def demo(count: int) -> List[Species]:
+    """Three species sharing `count` boids: a large flock, a faster one, and a few slow, loose wanderers."""
+    return [
+        Species("starling", count - count // 4 - count // 10, (1.0, 0.4, 0.2), avoid_range=40.),
+        Species("swift", count // 4, (0.3, 0.7, 1.0), max_speed=140., align_range=50., avoid_range=40.),
+        Species(
+            "heron", count // 10, (0.9, 0.9, 0.3),
+            max_force=6., max_speed=60., align_range=120., separate_range=60.
+        ),
+    ]
+
+
+class Scene(Recorded):
+    """
+    Several flocks, one per Species, stepped together.
+
+    Every boid of every flock goes in one neighbor index, so a single query per
+    boid finds both the boids of its own species it flocks with and the others it
+    avoids. The flocks' render states are gathered into one boid_data, with a
+    species byte per boid in species_data, so BoidRenderer draws the whole scene
+    in one call. A recording holds the boids but not their species.
+    """
+
+    def __init__(
+            self, species: Sequence[Species], bound_radius: float, backend: str = "grid",
+            timer: Optional[Timer] = None, seed: Optional[int] = None
+    ):
+        if len(species) > MAX_SPECIES:
+            raise ValueError(f"A scene holds at most {MAX_SPECIES} species, not {len(species)}")
+
+        self.species = list(species)
+        self.bound = bound_radius
+        self.timer = timer
+        self.seed, self.random = seeded(seed)
+
+        # Each species starts in its own place around the origin, and draws from its own seed.
+        self.flocks: List[Flock] = []
+        for k, kind in enumerate(self.species):
+            angle = tau * k / len(self.species)
+            start = Vec2(bound_radius / 2 * cos(angle), bound_radius / 2 * sin(angle))
+            self.flocks.append(Flock(
+                kind.count, start, bound_radius, backend, seed=self.random.getrandbits(32), boid_type=kind.boid_type
+            ))
+
+        self.reach = max((kind.reach for kind in self.species), default=Boid.ALIGN_RANGE)
+        if backend == "quadtree":
+            self.index = QuadTree()
+        elif backend == "grid":
+            self.index = SpatialHash(self.reach)
+        else:
+            raise ValueError(f"Unknown neighbor backend {backend!r}, expected one of {Flock.BACKENDS}")
+
+        # (x, y, boid) for every boid, flock by flock, at the start of the current tick.
+        self.snapshot: List[Tuple[float, float, Boid]] = []
+
+        self.count = 0
+        self.boid_data = (c_float * 0)()
+        self.species_data = (c_ubyte * 0)()
+
+        # Bumped whenever a boid is added or removed, so species_data has to be uploaded again.
+        self.revision = 0
+        self.gather()
+
+    @property
+    def colors(self) -> List[Color]:
+        return [kind.color for kind in self.species]
+
+    def add(self, x: float, y: float, species: int = 0) -> Boid:
+        """Add a boid of the `species`th species at (x, y)."""
+        boid = self.flocks[species].add(x, y)
+        self.gather()
+        return boid
+
+    def remove(self, index: int) -> Boid:
+        """Remove the boid at `index` of boid_data. Boids after it in its flock may move."""
+        for flock in self.flocks:
+            if index < flock.count:
+                boid = flock.remove(index)
+                self.gather()
+                return boid
+
+            index -= flock.count
+
+        raise IndexError("Scene index out of range")
+
+    def gather(self):
+        """Lay every flock's boids out one flock after another in boid_data, and their species in species_data."""
+        count = sum(flock.count for flock in self.flocks)
+        if count != self.count or not self.revision:
+            if 3 * count > len(self.boid_data):
+                # Doubles, like Flock.reserve.
+                self.boid_data = (c_float * (3 * max(count, 2 * len(self.boid_data) // 3)))()
+
+            species_data = (c_ubyte * count)()
+            offset = 0
+            for k, flock in enumerate(self.flocks):
+                memset(addressof(species_data) + offset, k, flock.count)
+                offset += flock.count
+
+            self.species_data = species_data
+            self.count = count
+            self.revision += 1
+
+        address = addressof(self.boid_data)
+        for flock in self.flocks:
+            size = flock.count * STRIDE
+            memmove(address, flock.boid_data, size)
+            address += size
+
+    def update(self, dt: float):
+        clock = perf_counter
+        start = clock()
+
+        self.snapshot = [(boid.position.x, boid.position.y, boid) for flock in self.flocks for boid in flock.data]
+        self.index.rebuild(self.snapshot)
+
+        rebuilt = clock()
+        for flock in self.flocks:
+            flock.integrate(dt)
+
+        integrated = clock()
+
+        neighbors_time = steering_time = 0.
+        snapshot = self.snapshot
+        query = self.index.query
+        first = 0
+        for kind, flock in zip(self.species, self.flocks):
+            boid_type = kind.boid_type
+            # Only as far as this species looks, the index is sized for the furthest.
+            reach = kind.reach
+            ar2 = boid_type.ALIGN_RANGE * boid_type.ALIGN_RANGE
+            avoid2 = kind.avoid_range * kind.avoid_range
+
+            for i in range(flock.count):
+                x, y, boid = snapshot[first + i]
+                before = clock()
+
+                # ****** Neighbors ******
+                nearby = query(x, y, reach)
+                same = [(other, d) for other, d in nearby if other.__class__ is boid_type and d < ar2]
+                others = [other for other, d in nearby if other.__class__ is not boid_type and d < avoid2]
+
+                gathered = clock()
+
+                flock.steer(i, boid, *boid.flock(same))
+                if others:
+                    # Separation from the other species, at full strength.
+                    boid.acceleration.add(boid.separation(others))
+
+                after = clock()
+                neighbors_time += gathered - before
+                steering_time += after - gathered
+
+            first += flock.count
+
+        self.gather()
+        self.record(
+            index=rebuilt - start, neighbors=neighbors_time, integration=integrated - rebuilt, steering=steering_time
+        )
@@ -1,6 +1,6 @@
 import ctypes as c
 from dataclasses import dataclass
-from typing import Tuple, Dict, Iterator, ClassVar
+from typing import Any, Tuple, Dict, Iterator, ClassVar, List, Optional, Sequence
 
 from pyglet.gl import *
 
@@ -43,6 +43,11 @@ class Location:
     def __int__(self):
         return self.value
 
+    @property
+    def _as_parameter_(self) -> int:
+        # Lets a Location be passed straight to the GL functions.
+        return self.value
+
 
 class Uniform:
     name: ClassVar[bytes]
@@ -55,19 +60,30 @@ class Uniform:
         self.uniform = self.program.get_uniform_location(self.name)
 
 
+def projection(width: int, height: int, zoom: float = 1.) -> Tuple[float, ...]:
+    """Map a width by height pixel window onto the world, `zoom` pixels per world unit, centered on the origin."""
+    return (
+        2 * zoom / width, 0.,                0., 0.,
+        0.,               2 * zoom / height, 0., 0.,
+        0.,               0.,                1., 0.,
+        0.,               0.,                0., 1.,
+    )
+
+
 class World(Uniform):
     name: bytes = b'u_Projection'
 
-    def set(self, width: int, height: int):
+    def set(self, width: int, height: int, zoom: float = 1.):
         if self.uniform:
-            self.program.set_uniform_matrix4fv(
-                self.uniform, (
-                    2 / width, 0.,         0., 0.,
-                    0.,        2 / height, 0., 0.,
-                    0.,        0.,         1., 0.,
-                    0.,        0.,         0., 1.,
-                )
-            )
+            self.program.set_uniform_matrix4fv(self.uniform, projection(width, height, zoom))
+
+
+class Alpha(Uniform):
+    name: bytes = b'u_Alpha'
+
+    def set(self, alpha: float):
+        if self.uniform:
+            self.program.set_uniform_1f(self.uniform, alpha)
 
 
 Mat4 = (GLfloat * 16)
@@ -75,25 +91,69 @@ Mat4 = (GLfloat * 16)
 
 # noinspection PyMethodMayBeStatic
 class Shader:
+    # Program last bound through any Shader, so binding it again can be skipped.
+    bound: ClassVar[int] = 0
+
     location_map: Dict[bytes, Location]
     id: GLuint
 
-    def __init__(self, vertex: bytes, fragment: bytes):
+    # Last value set for each uniform location, so setting it again can be skipped.
+    uniform_cache: Dict[int, Any]
+
+    _previous: List[int]
+    _matrix: "Mat4"
+
+    def __init__(self, vertex: bytes, fragment: Optional[bytes] = None, varyings: Sequence[bytes] = ()):
+        """
+        Link a program from its sources. A program that only feeds transform
+        feedback needs no fragment shader, just the `varyings` to capture, each
+        into its own buffer.
+        """
         self.location_map = {}
+        self.uniform_cache = {}
+        self._previous = []
+        self._matrix = Mat4()
 
         self.id = glCreateProgram()
 
-        vs: GLuint = self.compile_shader(GL_VERTEX_SHADER, vertex)
-        fs: GLuint = self.compile_shader(GL_FRAGMENT_SHADER, fragment)
+        shaders = [self.compile_shader(GL_VERTEX_SHADER, vertex)]
+        if fragment is not None:
+            shaders.append(self.compile_shader(GL_FRAGMENT_SHADER, fragment))
 
-        glAttachShader(self.id, vs)
-        glAttachShader(self.id, fs)
+        for shader in shaders:
+            glAttachShader(self.id, shader)
+
+        if varyings:
+            # Has to be set before linking.
+            names = [c.create_string_buffer(name) for name in varyings]
+            c_names = (c.POINTER(GLchar) * len(names))(
+                *(c.cast(c.pointer(name), c.POINTER(GLchar)) for name in names)
+            )
+            glTransformFeedbackVaryings(self.id, len(names), c_names, GL_SEPARATE_ATTRIBS)
 
         glLinkProgram(self.id)
+        self.check_link()
         glValidateProgram(self.id)
 
-        glDeleteShader(vs)
-        glDeleteShader(fs)
+        for shader in shaders:
+            glDeleteShader(shader)
+
+    def check_link(self):
+        result = GLint(0)
+        glGetProgramiv(self.id, GL_LINK_STATUS, c.byref(result))
+        if result.value == GL_FALSE:
+            message_length = GLint()
+            glGetProgramiv(self.id, GL_INFO_LOG_LENGTH, c.byref(message_length))
+            error_buffer = c.create_string_buffer(message_length.value)
+
+            glGetProgramInfoLog(
+                self.id,
+                message_length,
+                c.byref(message_length),
+                c.cast(c.pointer(error_buffer), c.POINTER(GLchar))
+            )
+
+            raise Exception(f"Failed to link program: {str(error_buffer.value, 'ascii')}")
 
     @staticmethod
     def compile_shader(mode: int, source: bytes):
@@ -161,22 +221,53 @@ class Shader:
         return location
 
     def set_uniform_1i(self, location: Location, value: int):
+        if self._cached(location, value):
+            return
+
         with self:
             glUniform1i(location, value)
 
+    def set_uniform_1f(self, location: Location, value: float):
+        if self._cached(location, value):
+            return
+
+        with self:
+            glUniform1f(location, value)
+
     def set_uniform_4f(self, location: Location, data: Iterator[float]):
+        data = tuple(data)
+        if self._cached(location, data):
+            return
+
         with self:
             glUniform4f(location, *data)
 
     def set_uniform_matrix4fv(self, location: Location, data: Tuple[float, ...]):
+        if self._cached(location, tuple(data)):
+            return
+
+        # Filled in place rather than allocating a ctypes array per call.
+        matrix = self._matrix
+        matrix[:] = data
         with self:
-            c_data = (GLfloat * len(data))(*data)
-            glUniformMatrix4fv(location, 1, GL_FALSE, c_data)
+            glUniformMatrix4fv(location, 1, GL_FALSE, matrix)
 
     def set_uniform_matrix4fv_raw(self, location: Location, c_data: Mat4):
+        if self._cached(location, tuple(c_data)):
+            return
+
         with self:
             glUniformMatrix4fv(location, 1, GL_FALSE, c_data)
 
+    def _cached(self, location: Location, value) -> bool:
+        """Whether `location` already holds `value`. If not, remember that it is about to."""
+        key = location.value
+        if self.uniform_cache.get(key) == value:
+            return True
+
+        self.uniform_cache[key] = value
+        return False
+
     def get_uniform_fv(self, location: Location, size: int) -> Tuple[float, ...]:
         with self:
             buffer = (GLfloat * size)()
@@ -192,21 +283,78 @@ class Shader:
             return tuple(buffer)
 
     def bind(self):
-        glUseProgram(self.id)
+        if Shader.bound != self.id:
+            glUseProgram(self.id)
+            Shader.bound = self.id
 
     def unbind(self):
-        glUseProgram(0)
+        if Shader.bound != 0:
+            glUseProgram(0)
+            Shader.bound = 0
 
     def __enter__(self) -> GLuint:
+        # Restore whatever was bound before on exit, so uniforms set inside a
+        # `with shader:` block are batched under the one bind.
+        self._previous.append(Shader.bound)
         self.bind()
         return self.id
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.unbind()
+        previous = self._previous.pop()
+        if Shader.bound != previous:
+            glUseProgram(previous)
+            Shader.bound = previous
+
+
+class UniformBuffer:
+    """
+    A uniform buffer object, for std140 uniform blocks shared between programs.
+    One upload changes the block in every program attached to the same binding.
+    """
+
+    __slots__ = "id", "binding", "size"
+
+    id: GLuint
+    binding: int
+    size: int
+
+    def __init__(self, binding: int, size: int):
+        self.binding = binding
+        self.size = size
+
+        self.id = GLuint(0)
+        glGenBuffers(1, c.byref(self.id))
+        glBindBuffer(GL_UNIFORM_BUFFER, self.id)
+        glBufferData(GL_UNIFORM_BUFFER, size, None, GL_DYNAMIC_DRAW)
+        glBindBuffer(GL_UNIFORM_BUFFER, 0)
+
+        glBindBufferBase(GL_UNIFORM_BUFFER, binding, self.id)
+
+    def attach(self, program: Shader, block: bytes):
+        """Feed `program`'s uniform block named `block` from this buffer."""
+        name_buffer = c.create_string_buffer(block)
+        index = glGetUniformBlockIndex(program.id, c.cast(c.pointer(name_buffer), c.POINTER(GLchar)))
+        if index != GL_INVALID_INDEX:
+            glUniformBlockBinding(program.id, index, self.binding)
+
+    def update(self, data: c.Array, offset: int = 0):
+        glBindBuffer(GL_UNIFORM_BUFFER, self.id)
+        glBufferSubData(GL_UNIFORM_BUFFER, offset, c.sizeof(data), data)
+        glBindBuffer(GL_UNIFORM_BUFFER, 0)
+
+
+# Programs are compiled the first time they are asked for, never at import.
+_shader_cache: Dict[Tuple[bytes, bytes], Shader] = {}
+
 
+def get_shader(vertex: bytes, fragment: bytes) -> Shader:
+    try:
+        shader = _shader_cache[vertex, fragment]
+    except KeyError:
+        _shader_cache[vertex, fragment] = shader = Shader(vertex, fragment)
 
-_default_shader = Shader(vertex_source, fragment_source)
+    return shader
 
 
-def get_default_shader():
-    return _default_shader
+def get_default_shader() -> Shader:
+    return get_shader(vertex_source, fragment_source)
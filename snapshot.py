@@ -0,0 +1,131 @@
+"""
+Binary snapshots of a whole Flock, to checkpoint a run and resume it exactly.
+
+A snapshot is, in order and little-endian:
+
+    HEADER       magic, version, count, seed, next name, bound, Boid parameters, backend, pairwise
+    RANDOM       the flock's Mersenne Twister state
+    names        one int64 per boid
+    state        six float64 per boid: x, y, vx, vy, ax, ay
+
+Every section has a fixed size given the count, so loading memory-maps the file
+and copies each array out in one slice.
+"""
+import mmap
+import struct
+import sys
+from array import array
+from math import isnan, nan
+from typing import Optional
+
+from boid import ORIGIN, Boid, Flock
+from timer import Timer
+from vectors import Vec2
+
+MAGIC = b"FLOXSNAP"
+VERSION = 1
+
+HEADER = struct.Struct("<8sIIqqd4d16s?")
+RANDOM = struct.Struct("<625Id")
+
+# Floats per boid in the state section.
+STATE = 6
+
+
+def parameters():
+    return Boid.MAX_FORCE, Boid.MAX_SPEED, Boid.ALIGN_RANGE, Boid.SEPARATE_RANGE
+
+
+def little_endian(values: array) -> array:
+    if sys.byteorder != "little":
+        values.byteswap()
+
+    return values
+
+
+def save(flock: Flock, path: str):
+    """Write every boid and everything else needed to carry on stepping `flock` exactly."""
+    if not isinstance(flock, Flock):
+        raise TypeError(f"Only the object engines can be snapshot, not {type(flock).__name__}")
+
+    if flock.boid_type is not Boid:
+        # Only Boid's own parameters are stored.
+        raise TypeError(f"Only flocks of plain Boids can be snapshot, not {flock.boid_type.__name__}")
+
+    names = array("q")
+    state = array("d")
+    for boid in flock.data:
+        names.append(boid.name)
+        state.extend((
+            boid.position.x, boid.position.y,
+            boid.velocity.x, boid.velocity.y,
+            boid.acceleration.x, boid.acceleration.y,
+        ))
+
+    version, words, gauss = flock.random.getstate()
+
+    with open(path, "wb") as file:
+        file.write(HEADER.pack(
+            MAGIC, VERSION, flock.count, flock.seed, flock.next_name, flock.bound,
+            *parameters(), flock.backend.encode("ascii"), flock.pairwise
+        ))
+        file.write(RANDOM.pack(*words, nan if gauss is None else gauss))
+        file.write(little_endian(names).tobytes())
+        file.write(little_endian(state).tobytes())
+
+
+def load(path: str, timer: Optional[Timer] = None) -> Flock:
+    """Read a snapshot written by save back into a new Flock."""
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        if len(mapped) < HEADER.size or mapped[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a flock snapshot")
+
+        (
+            _, version, count, seed, next_name, bound,
+            max_force, max_speed, align_range, separate_range, backend, pairwise
+        ) = HEADER.unpack_from(mapped, 0)
+
+        if version != VERSION:
+            raise ValueError(f"Unsupported snapshot version {version}, expected {VERSION}")
+
+        if (max_force, max_speed, align_range, separate_range) != parameters():
+            raise ValueError(f"{path} was taken with different Boid parameters")
+
+        *words, gauss = RANDOM.unpack_from(mapped, HEADER.size)
+
+        offset = HEADER.size + RANDOM.size
+        names = array("q")
+        names.frombytes(mapped[offset:offset + count * names.itemsize])
+        offset += count * names.itemsize
+
+        state = array("d")
+        state.frombytes(mapped[offset:offset + count * STATE * state.itemsize])
+
+        if len(state) != count * STATE:
+            raise ValueError(f"{path} is truncated")
+
+    little_endian(names)
+    little_endian(state)
+
+    flock = Flock(0, ORIGIN, bound, backend.rstrip(b"\0").decode("ascii"), timer, pairwise, seed)
+    flock.reserve(count)
+
+    data = flock.data
+    boid_data = flock.boid_data
+    for i in range(count):
+        x, y, vx, vy, ax, ay = state[i * STATE:(i + 1) * STATE]
+
+        boid = Boid(names[i], x, y, velocity=Vec2(vx, vy))
+        boid.acceleration.x = ax
+        boid.acceleration.y = ay
+        data.append(boid)
+
+        boid_data[3 * i + 0] = x
+        boid_data[3 * i + 1] = y
+        boid_data[3 * i + 2] = boid.heading
+
+    flock.count = count
+    flock.next_name = next_name
+    flock.random.setstate((3, tuple(words), None if isnan(gauss) else gauss))
+
+    return flock
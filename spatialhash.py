@@ -0,0 +1,109 @@
+from math import ceil, floor
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+Point = Tuple[float, float, Any]
+Cell = Tuple[int, int]
+
+
+class SpatialHash:
+    """Uniform grid of square cells, bucketed in a dict keyed by cell coordinates."""
+
+    __slots__ = "cell_size", "inverse", "cells"
+
+    cell_size: float
+    inverse: float
+    cells: Dict[Cell, List[Point]]
+
+    def __init__(self, cell_size: float):
+        self.cell_size = cell_size
+        self.inverse = 1. / cell_size
+        self.cells = {}
+
+    def clear(self):
+        self.cells = {}
+
+    def insert(self, x: float, y: float, item: Any):
+        inverse = self.inverse
+        key = (floor(x * inverse), floor(y * inverse))
+        try:
+            self.cells[key].append((x, y, item))
+        except KeyError:
+            self.cells[key] = [(x, y, item)]
+
+    def rebuild(self, points: Iterable[Point]):
+        self.clear()
+
+        cells = self.cells
+        inverse = self.inverse
+        for point in points:
+            key = (floor(point[0] * inverse), floor(point[1] * inverse))
+            try:
+                cells[key].append(point)
+            except KeyError:
+                cells[key] = [point]
+
+    def query(self, x: float, y: float, radius: float) -> List[Tuple[Any, float]]:
+        """Return (item, squared distance) for every point strictly within radius of (x, y)."""
+        found = []
+        r2 = radius * radius
+
+        inverse = self.inverse
+        min_cx, max_cx = floor((x - radius) * inverse), floor((x + radius) * inverse)
+        min_cy, max_cy = floor((y - radius) * inverse), floor((y + radius) * inverse)
+
+        cells = self.cells
+        for cx in range(min_cx, max_cx + 1):
+            for cy in range(min_cy, max_cy + 1):
+                try:
+                    bucket = cells[cx, cy]
+                except KeyError:
+                    continue
+
+                for px, py, item in bucket:
+                    dx = px - x
+                    dy = py - y
+                    d2 = dx * dx + dy * dy
+                    if d2 < r2:
+                        found.append((item, d2))
+
+        return found
+
+    def pairs(self, radius: float) -> Iterator[Tuple[Any, Any, float]]:
+        """Yield (item, item, squared distance) once for every unordered pair strictly within radius."""
+        r2 = radius * radius
+
+        # Only the forward half of the surrounding cells, so each pair of cells is visited once.
+        reach = ceil(radius * self.inverse)
+        forward = [
+            (dx, dy)
+            for dx in range(0, reach + 1)
+            for dy in range(-reach, reach + 1)
+            if dx > 0 or dy > 0
+        ]
+
+        cells = self.cells
+        for (cx, cy), bucket in cells.items():
+            # Pairs inside this cell.
+            for a in range(len(bucket)):
+                ax, ay, item = bucket[a]
+                for b in range(a + 1, len(bucket)):
+                    bx, by, other = bucket[b]
+                    dx = bx - ax
+                    dy = by - ay
+                    d2 = dx * dx + dy * dy
+                    if d2 < r2:
+                        yield item, other, d2
+
+            for ox, oy in forward:
+                try:
+                    neighbor = cells[cx + ox, cy + oy]
+                except KeyError:
+                    continue
+
+                for ax, ay, item in bucket:
+                    for bx, by, other in neighbor:
+                        dx = bx - ax
+                        dy = by - ay
+                        d2 = dx * dx + dy * dy
+                        if d2 < r2:
+                            yield item, other, d2
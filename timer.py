@@ -1,58 +1,114 @@
-import matplotlib.pyplot as plt
-
-from dataclasses import dataclass
+from array import array
 from time import perf_counter
-from typing import Dict, Callable, List
+from typing import Dict, Callable, Tuple
+
+
+class Section:
+    """
+    Timing samples for one named section, kept in a fixed-size ring buffer.
 
+    A Section is also a reusable context manager, so hot code can hold on to one
+    and time a block with `with section:` without any lookups or allocation.
+    """
 
-@dataclass
-class TimedOperation:
-    times: List[float]
+    __slots__ = "name", "samples", "index", "count", "total", "min", "max", "_start"
+
+    name: str
+    samples: array
+    index: int
+    count: int
+    total: float
     min: float
     max: float
 
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.samples = array('d', bytes(8 * size))
+        self.index = 0
+        self.count = 0
+        self.total = 0.
+        self.min = float("inf")
+        self.max = 0.
+        self._start = 0.
+
+    def record(self, dt: float):
+        samples = self.samples
+        samples[self.index] = dt
+        self.index = (self.index + 1) % len(samples)
+
+        self.count += 1
+        self.total += dt
+        if dt < self.min:
+            self.min = dt
+        if dt > self.max:
+            self.max = dt
+
+    def __enter__(self) -> "Section":
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.record(perf_counter() - self._start)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.
+
+    def percentile(self, percent: float) -> float:
+        """Nearest-rank percentile over the samples still held in the ring buffer."""
+        held = sorted(self.samples[:min(self.count, len(self.samples))])
+        if not held:
+            return 0.
+
+        rank = round(percent / 100. * (len(held) - 1))
+        return held[rank]
+
 
 class Timer:
-    def __init__(self):
-        self.times: Dict[str, TimedOperation] = {}
+    def __init__(self, size: int = 1024):
+        self.size = size
+        self.times: Dict[str, Section] = {}
+
+    def section(self, name: str) -> Section:
+        try:
+            section = self.times[name]
+        except KeyError:
+            self.times[name] = section = Section(name, self.size)
+
+        return section
+
+    def record(self, name: str, dt: float):
+        self.section(name).record(dt)
 
     def timed(self, func: Callable):
-        times = self.times
+        section = self.section(func.__qualname__)
 
         def wrapper(*args, **kwargs):
-            nonlocal times
-
             start = perf_counter()
             retval = func(*args, **kwargs)
-            dt = perf_counter() - start
-            try:
-                operation = times[func.__qualname__]
-                operation.times.append(dt)
-
-                if dt < operation.min:
-                    operation.min = dt
-                elif dt > operation.max:
-                    operation.max = dt
-            except KeyError:
-                times[func.__qualname__] = TimedOperation([dt], dt, dt)
+            section.record(perf_counter() - start)
             return retval
 
         return wrapper
 
-    def calculate(self):
+    def calculate(self) -> Dict[str, Tuple[float, float, float]]:
         return {
-            key: (sum(operation.times) / len(operation.times), operation.min, operation.max)
-            for key, operation in self.times.items()
+            key: (section.mean, section.min, section.max)
+            for key, section in self.times.items()
         }
 
-    def show_graph(self):
-        for name, operation in self.times.items():
-            sub = operation.times[20:80]
-            print(f"{name}: {sum(sub) / len(sub)}")
-            plt.plot(sub)
-        plt.show()
+    def percentiles(self) -> Dict[str, Tuple[float, float, float]]:
+        return {
+            key: (section.percentile(50.), section.percentile(95.), section.percentile(99.))
+            for key, section in self.times.items()
+        }
 
     def show(self):
-        for function_name, time_data in self.calculate().items():
-            mean_s, min_s, max_s = time_data
-            print(f"    {function_name}: {mean_s:.7f} ({min_s:.7f} min) ({max_s:.7f} max)")
+        percentiles = self.percentiles()
+        for name, (mean_s, min_s, max_s) in self.calculate().items():
+            p50, p95, p99 = percentiles[name]
+            print(
+                f"    {name}: {mean_s * 1000.:.3f}ms mean "
+                f"(p50 {p50 * 1000.:.3f}ms) (p95 {p95 * 1000.:.3f}ms) (p99 {p99 * 1000.:.3f}ms) "
+                f"({min_s * 1000.:.3f}ms min) ({max_s * 1000.:.3f}ms max)"
+            )
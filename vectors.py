@@ -1,16 +1,33 @@
-from dataclasses import dataclass
 from math import tau, cos, sin, atan2, sqrt
-from random import random
+from random import Random, random
+from typing import Optional
 
 
-@dataclass
 class Vec2:
-    x: float = 0.
-    y: float = 0.
+    # Slotted rather than a dataclass so every vector stays two floats, without a __dict__.
+    __slots__ = "x", "y"
+
+    x: float
+    y: float
+
+    def __init__(self, x: float = 0., y: float = 0.):
+        self.x = x
+        self.y = y
+
+    def __repr__(self) -> str:
+        return f"Vec2(x={self.x!r}, y={self.y!r})"
+
+    def __eq__(self, other) -> bool:
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self.x == other.x and self.y == other.y
+
+    # Mutable, so unhashable like the dataclass it replaces.
+    __hash__ = None
 
     @classmethod
-    def from_random(cls, strength: float):
-        angle = tau * random()
+    def from_random(cls, strength: float, rng: Optional[Random] = None):
+        angle = tau * (random() if rng is None else rng.random())
         return cls(
             strength * cos(angle),
             strength * sin(angle)
@@ -42,19 +59,46 @@ class Vec2:
         self.muls(ratio)
 
     def limited(self, magnitude: float):
-        my_mag = self.distance_2(Vec2())
+        x, y = self.x, self.y
+        my_mag = x * x + y * y
         if 0. < magnitude * magnitude < my_mag:
-            ratio = magnitude / self.magnitude
-            return Vec2(self.x * ratio, self.y * ratio)
+            ratio = magnitude / sqrt(my_mag)
+            return Vec2(x * ratio, y * ratio)
         else:
-            return Vec2(self.x, self.y)
+            return Vec2(x, y)
 
     def limit(self, magnitude: float):
-        my_mag = self.distance_2(Vec2())
+        x, y = self.x, self.y
+        my_mag = x * x + y * y
         if 0. < magnitude * magnitude < my_mag:
-            # if 0. < my_mag < magnitude * magnitude:
-            ratio = magnitude / self.magnitude
-            self.muls(ratio)
+            ratio = magnitude / sqrt(my_mag)
+            self.x = x * ratio
+            self.y = y * ratio
+
+    def steer(self, velocity: "Vec2", speed: float, force: float) -> "Vec2":
+        """
+        Turn this desired direction into a steering force in place: set its magnitude
+        to `speed`, subtract the current `velocity`, then limit it to `force`.
+        """
+        x, y = self.x, self.y
+        mag = sqrt(x * x + y * y)
+        if mag:
+            ratio = speed / mag
+            x *= ratio
+            y *= ratio
+
+        x -= velocity.x
+        y -= velocity.y
+
+        my_mag = x * x + y * y
+        if 0. < force * force < my_mag:
+            ratio = force / sqrt(my_mag)
+            x *= ratio
+            y *= ratio
+
+        self.x = x
+        self.y = y
+        return self
 
     def distance_to(self, other: "Vec2"):
         x = other.x - self.x
@@ -101,6 +145,12 @@ class Vec2:
         self.y += other.y
         return self
 
+    def add_scaled(self, other: "Vec2", scale: float) -> "Vec2":
+        """self += other * scale, without the temporary."""
+        self.x += other.x * scale
+        self.y += other.y * scale
+        return self
+
     def sub(self, other: "Vec2") -> "Vec2":
         self.x -= other.x
         self.y -= other.y
@@ -174,5 +224,11 @@ class Vec2:
         except ZeroDivisionError:
             pass
 
+    @property
+    def magnitude_2(self) -> float:
+        x, y = self.x, self.y
+        return x * x + y * y
+
     def copy(self):
         return Vec2(self.x, self.y)
+